@@ -0,0 +1,67 @@
+import threading  # runs the sampling loop next to the I2C polling
+import time
+import metrics
+
+DHT_READ_SECONDS = metrics.histogram('plantos_dht_read_seconds', "DHT22 read attempts", ['pin'])
+DHT_FAILURES = metrics.counter('plantos_dht_failures_total', "Failed DHT22 reads, each one retried after the interval", ['pin'])
+
+#
+#   DHT22 background sampling
+#
+
+class DHTSampler(threading.Thread):
+    # Reads a DHT sensor on its own thread and keeps the latest good reading.
+    # A bad read costs this thread a retry, the polling loop only ever picks up
+    # the cached value and its age through latest(), so it never waits on the sensor.
+
+    backend = None      # (read, sensor) used in place of Adafruit_DHT, e.g. by sensor_sim
+
+    def __init__(self, pin, sensor=None, interval=2.0, read=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if read is None and self.backend is not None:
+            read, sensor = self.backend[0], sensor or self.backend[1]
+        if read is None or sensor is None:
+            import Adafruit_DHT     # only needed when sampling real hardware
+            read = read or Adafruit_DHT.read
+            sensor = sensor or Adafruit_DHT.DHT22
+        self.read = read            # single read attempt, returns (humidity, temperature) or Nones
+        self.sensor = sensor
+        self.pin = pin
+        self.interval = interval    # the DHT22 needs 2 seconds between reads
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.humidity = None
+        self.temperature = None
+        self.timestamp = None
+        self.reads = 0
+        self.failures = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with DHT_READ_SECONDS.time(pin=self.pin):
+                    humidity, temperature = self.read(self.sensor, self.pin)
+            except Exception:
+                humidity, temperature = None, None
+            self.reads += 1
+            if humidity is not None and temperature is not None:
+                with self.lock:
+                    self.humidity = humidity
+                    self.temperature = temperature
+                    self.timestamp = time.time()
+            else:
+                self.failures += 1
+                DHT_FAILURES.inc(pin=self.pin)
+            self.stopped.wait(self.interval)
+
+    def latest(self):
+        # (humidity, temperature, age in seconds) of the last good reading,
+        # all None until the first one arrives
+        with self.lock:
+            if self.timestamp is None:
+                return None, None, None
+            return self.humidity, self.temperature, time.time() - self.timestamp
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,182 @@
+import ctypes     # builds the i2c-dev ioctl arguments
+import errno
+import fcntl      # used to access I2C parameters like addresses
+import os
+import threading
+import metrics
+
+#
+#   I2C bus manager
+#
+
+I2C_SLAVE = 0x0703          # ioctl numbers from i2c-dev.h of i2c-tools
+I2C_RDWR = 0x0707
+I2C_SMBUS = 0x0720
+I2C_M_RD = 0x0001           # message flag, read from the device
+I2C_SMBUS_WRITE = 0
+I2C_SMBUS_QUICK = 0
+
+class i2c_msg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(i2c_msg)),
+                ('nmsgs', ctypes.c_uint32)]
+
+class i2c_smbus_ioctl_data(ctypes.Structure):
+    _fields_ = [('read_write', ctypes.c_uint8),
+                ('command', ctypes.c_uint8),
+                ('size', ctypes.c_uint32),
+                ('data', ctypes.c_void_p)]
+
+I2C_ERRORS = metrics.counter('plantos_i2c_errors_total', "Failed I2C transactions", ['bus', 'address'])
+
+class I2CBus:
+    # One file descriptor per bus, shared by every device handle on it.
+    # Each transaction carries its slave address in an I2C_RDWR message, so switching
+    # between devices costs no I2C_SLAVE ioctl, and a write followed by a read can go
+    # out as one combined transaction with a repeated start. A lock serialises
+    # transactions so several threads can use the bus safely.
+
+    buses = {}
+    buses_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, bus=1):
+        # the shared manager of a bus, opened on first use
+        with cls.buses_lock:
+            if bus not in cls.buses:
+                cls.buses[bus] = cls(bus)
+            return cls.buses[bus]
+
+    @classmethod
+    def register(cls, bus, manager):
+        # installs another implementation for a bus number, e.g. a simulated bus
+        with cls.buses_lock:
+            cls.buses[bus] = manager
+
+    def __init__(self, bus=1):
+        self.bus = bus
+        self.fd = os.open("/dev/i2c-" + str(bus), os.O_RDWR)
+        self.lock = threading.RLock()
+        self.mux_selected = None    # (multiplexer address, channel) last selected by a MuxChannel
+
+    def transfer(self, *messages):
+        # runs (addr, data, read_length) messages as one transaction, data is written
+        # when read_length is 0, returns the bytes of every read message in order
+        try:
+            return self.raw_transfer(*messages)
+        except IOError:
+            I2C_ERRORS.inc(bus=self.bus, address=messages[0][0])
+            raise
+
+    def raw_transfer(self, *messages):
+        # transfer() without the error count, for probes where no answer is expected
+        msgs = (i2c_msg * len(messages))()
+        buffers = []
+        for i in range(len(messages)):
+            addr, data, length = messages[i]
+            if length:
+                buf = (ctypes.c_uint8 * length)()
+                msgs[i] = i2c_msg(addr, I2C_M_RD, length, buf)
+            else:
+                data = bytearray(data)
+                buf = (ctypes.c_uint8 * max(len(data), 1)).from_buffer(data or bytearray(1))
+                msgs[i] = i2c_msg(addr, 0, len(data), buf)
+            buffers.append((length, buf))
+        request = i2c_rdwr_ioctl_data(msgs, len(messages))
+        with self.lock:
+            fcntl.ioctl(self.fd, I2C_RDWR, request)
+        return [bytes(bytearray(buf)) for length, buf in buffers if length]
+
+    def write(self, addr, data):
+        self.transfer((addr, data, 0))
+
+    def read(self, addr, length):
+        return self.transfer((addr, None, length))[0]
+
+    def write_read(self, addr, data, length):
+        # write then read back without releasing the bus in between
+        return self.transfer((addr, data, 0), (addr, None, length))[0]
+
+    def quick(self, addr):
+        # SMBus quick write, True when a device acknowledges the address
+        quick = i2c_smbus_ioctl_data(I2C_SMBUS_WRITE, 0, I2C_SMBUS_QUICK, None)
+        with self.lock:
+            try:
+                fcntl.ioctl(self.fd, I2C_SLAVE, addr)
+            except IOError as e:
+                return e.errno == errno.EBUSY   # claimed by a kernel driver, so present
+            try:
+                fcntl.ioctl(self.fd, I2C_SMBUS, quick)
+                return True
+            except IOError:
+                return False
+
+    def close(self):
+        with self.buses_lock:
+            if self.buses.get(self.bus) is self:
+                del self.buses[self.bus]
+        os.close(self.fd)
+
+#
+#   TCA9548A multiplexer channels
+#
+
+class MuxChannel(I2CBus):
+    # One downstream channel of a TCA9548A multiplexer, used like a bus of its own.
+    # Every transaction first makes sure its channel is the one selected on the parent
+    # bus, holding the parent lock across both so a thread on another channel cannot
+    # switch it in between. The parent remembers the selection, so transactions that
+    # stay on one channel cost no extra write. Channel None is the upstream segment
+    # alone, with every channel of the multiplexer switched off.
+
+    def __init__(self, parent, mux, channel):
+        self.parent = parent
+        self.mux = mux
+        self.channel = channel
+        self.bus = channel_name(parent.bus, mux, channel)
+        self.lock = parent.lock
+
+    def select(self):
+        selected = self.parent.mux_selected
+        if selected == (self.mux, self.channel):
+            return
+        if selected is not None and selected[0] != self.mux:
+            self.parent.write(selected[0], [0])     # disconnect the channels of the other multiplexer
+        self.parent.mux_selected = None     # unknown until the write succeeds
+        self.parent.write(self.mux, [0 if self.channel is None else 1 << self.channel])
+        self.parent.mux_selected = (self.mux, self.channel)
+
+    def raw_transfer(self, *messages):
+        with self.lock:
+            self.select()
+            return self.parent.raw_transfer(*messages)
+
+    def quick(self, addr):
+        with self.lock:
+            self.select()
+            return self.parent.quick(addr)
+
+    def close(self):
+        with self.buses_lock:
+            if self.buses.get(self.bus) is self:
+                del self.buses[self.bus]
+
+def channel_name(bus, mux, channel):
+    if channel is None:
+        return "%s/0x%02x" % (bus, mux)
+    return "%s/0x%02x/%d" % (bus, mux, channel)
+
+def open_channel(bus, mux, channel):
+    # registers a multiplexer channel as a bus and returns the name to pass to the
+    # drivers in place of a bus number, e.g. AtlasI2C(bus=open_channel(1, 0x70, 2))
+    name = channel_name(bus, mux, channel)
+    with I2CBus.buses_lock:
+        registered = name in I2CBus.buses
+    if not registered:
+        I2CBus.register(name, MuxChannel(I2CBus.get(bus), mux, channel))
+    return name
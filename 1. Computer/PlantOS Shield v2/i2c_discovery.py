@@ -0,0 +1,114 @@
+import threading
+import time
+from i2c_bus import I2CBus
+
+#
+#   I2C bus discovery
+#
+
+# devices recognised by their address alone
+KNOWN_DEVICES = {0x23: 'BH1750',        # light sensor, ADDR pin low
+                 0x5c: 'BH1750'}        # light sensor, ADDR pin high
+for _addr in range(0x70, 0x78):
+    KNOWN_DEVICES[_addr] = 'TCA9548A'   # I2C multiplexer
+
+# default addresses of the Atlas Scientific EZO boards (DO, ORP, pH, EC, RTD, ...)
+ATLAS_RANGE = range(97, 112)
+KNOWN_RANGE = sorted(set(KNOWN_DEVICES) | set(ATLAS_RANGE))
+
+# like i2cdetect, addresses where EEPROMs usually live are probed with a read, not a write
+READ_PROBE = set(range(0x30, 0x38)) | set(range(0x50, 0x60))
+
+class I2CDiscovery:
+    # Finds and identifies the devices on a bus and caches them as a device map of
+    # {address: type}. Probing uses SMBus quick writes, which carry no data, through the
+    # shared I2CBus so it never races the sensor handles on the bus. Atlas boards are
+    # identified with a single "I" command sent to all of them at once. The map is only
+    # rebuilt by refresh(), e.g. on demand or after a failed transaction.
+
+    identify_timeout = 0.3      # the time an Atlas board needs to answer "I"
+
+    def __init__(self, bus=1, addresses=None):
+        self.bus = bus
+        self.addresses = addresses      # addresses to probe, None probes the whole bus
+        self.lock = threading.Lock()
+        self.devices = None
+
+    def probe(self, addresses=None):
+        # returns the addresses that acknowledge, in order
+        if addresses is None:
+            addresses = self.addresses if self.addresses is not None else range(0x03, 0x78)
+        bus = I2CBus.get(self.bus)
+        found = []
+        for addr in addresses:
+            if addr in READ_PROBE:
+                try:
+                    bus.raw_transfer((addr, None, 1))   # a missing device is not an error
+                    found.append(addr)
+                except (IOError, OSError):
+                    pass
+            elif bus.quick(addr):
+                found.append(addr)
+        return found
+
+    def identify(self, addresses):
+        # returns {address: type} for addresses answering the Atlas "I" command
+        # with "?I,<type>,<firmware>"
+        bus = I2CBus.get(self.bus)
+        types = {}
+        asked = []
+        for addr in addresses:
+            try:
+                bus.write(addr, b"I\x00")
+                asked.append(addr)
+            except (IOError, OSError):
+                pass
+        if asked:
+            time.sleep(self.identify_timeout)
+        for addr in asked:
+            try:
+                data = bytearray(bus.read(addr, 31)).replace(b'\x00', b'')
+            except (IOError, OSError):
+                continue
+            if len(data) > 1 and data[0] == 1:
+                fields = ''.join([chr(c & ~0x80) for c in data[1:]]).split(',')
+                if len(fields) > 1 and fields[0].upper() == '?I':
+                    types[addr] = fields[1]
+        return types
+
+    def refresh(self):
+        # probes the bus again, devices that are already known keep their type
+        # so only new addresses are identified
+        with self.lock:
+            previous = self.devices or {}
+            present = self.probe()
+            devices = {}
+            unknown = []
+            for addr in present:
+                if previous.get(addr, 'unknown') != 'unknown':
+                    devices[addr] = previous[addr]
+                elif addr in KNOWN_DEVICES:
+                    devices[addr] = KNOWN_DEVICES[addr]
+                else:
+                    devices[addr] = 'unknown'
+                    if addr in ATLAS_RANGE:     # never send "I" to devices that may not be Atlas boards
+                        unknown.append(addr)
+            devices.update(self.identify(unknown))
+            self.devices = devices
+            return dict(devices)
+
+    def device_map(self):
+        # cached {address: type}, built on first use
+        if self.devices is None:
+            return self.refresh()
+        return dict(self.devices)
+
+    def find(self, kind):
+        # addresses of every device of a type, e.g. 'pH' or 'BH1750'
+        devices = self.device_map()
+        return sorted([addr for addr in devices if devices[addr] == kind])
+
+    def atlas_addresses(self):
+        devices = self.device_map()
+        return sorted([addr for addr in devices
+                       if devices[addr] not in ('unknown', 'BH1750', 'TCA9548A')])
@@ -0,0 +1,95 @@
+import threading  # runs the sampling loop next to the I2C polling
+import time
+from collections import deque
+import metrics
+
+LIGHT_FAILURES = metrics.counter('plantos_light_failures_total', "Failed BH1750 reads, the mode is sent again", ['address'])
+LIGHT_MODE_CHANGES = metrics.counter('plantos_light_mode_changes_total', "BH1750 resolution switches", ['address'])
+
+#
+#   BH1750 background sampling
+#
+
+class LightSampler(threading.Thread):
+    # Keeps a BH1750 in one of its continuous modes and reads the result register at
+    # a fixed rate on its own thread, so no reading pays the power-up and conversion
+    # time of a one-shot measurement. latest() averages the last samples, and the
+    # mode follows the light level: 0.5lx steps up to HIGH_RES_MODE_2 saturation,
+    # 4lx steps with a short conversion time above it, with a gap between the two
+    # switching points so the mode does not flap around the threshold.
+
+    to_low_res = 25000          # lx, HIGH_RES_MODE_2 saturates at 27306 lx
+    to_high_res = 20000         # lx
+
+    def __init__(self, sensor, addr=None, interval=0.25, oversample=8, adaptive=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sensor = sensor        # BH1750 driver
+        self.addr = addr if addr is not None else sensor.default_address
+        self.adaptive = adaptive
+        self.mode = sensor.CONTINUOUS_HIGH_RES_MODE_2
+        self.interval = interval    # seconds between reads, never shorter than a conversion
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.samples = deque(maxlen=oversample)     # (timestamp, lux) of the last reads
+        self.reads = 0
+        self.failures = 0
+        self.mode_changes = 0
+
+    def run(self):
+        started = False
+        while not self.stopped.is_set():
+            try:
+                if not started:
+                    # (re)start the conversion, the register is stale until one has completed
+                    self.sensor.setMode(self.mode, self.addr)
+                    started = True
+                    self.stopped.wait(self.sensor.measurementTime(self.mode))
+                lux = self.sensor.readContinuous(self.mode, self.addr)
+            except (IOError, OSError):
+                self.failures += 1
+                LIGHT_FAILURES.inc(address=self.addr)
+                started = False     # the chip may have reset, send the mode again
+                self.stopped.wait(self.period())
+                continue
+            self.reads += 1
+            with self.lock:
+                self.samples.append((time.time(), lux))
+            mode = self.choose_mode(lux)
+            if mode != self.mode:
+                self.mode = mode
+                self.mode_changes += 1
+                LIGHT_MODE_CHANGES.inc(address=self.addr)
+                started = False
+                with self.lock:
+                    self.samples.clear()    # samples of both modes are not mixed
+                continue
+            self.stopped.wait(self.period())
+        try:
+            self.sensor.powerDown(self.addr)
+        except (IOError, OSError):
+            pass
+
+    def period(self):
+        return max(self.interval, self.sensor.measurementTime(self.mode))
+
+    def choose_mode(self, lux):
+        if not self.adaptive:
+            return self.mode
+        if self.mode == self.sensor.CONTINUOUS_HIGH_RES_MODE_2 and lux >= self.to_low_res:
+            return self.sensor.CONTINUOUS_LOW_RES_MODE
+        if self.mode == self.sensor.CONTINUOUS_LOW_RES_MODE and lux < self.to_high_res:
+            return self.sensor.CONTINUOUS_HIGH_RES_MODE_2
+        return self.mode
+
+    def latest(self):
+        # (mean lux of the buffered samples, age in seconds of the newest one),
+        # both None until the first sample arrives
+        with self.lock:
+            if not self.samples:
+                return None, None
+            lux = sum([s[1] for s in self.samples]) / len(self.samples)
+            return lux, time.time() - self.samples[-1][0]
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,241 @@
+import bisect
+import os
+import sys
+import threading
+import time
+import scheduler    # monotonic clock, read through the module so sensor_sim can replace it
+
+#
+#   Runtime metrics
+#
+#   Counters, gauges and latency histograms kept in memory, keyed by label values such
+#   as the device address, and rendered in the Prometheus text format. serve() exposes
+#   them over HTTP at /metrics, dump() writes them to a file, e.g. from a scheduler job.
+#
+
+# seconds, from an I2C transaction to a slow DHT22 read
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                           for name, value in pairs]) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    # one metric family, its series are keyed by the tuple of their label values
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("%s takes the labels %s" % (self.name, ', '.join(self.labels)))
+        return tuple([str(labels[name]) for name in self.labels])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key in sorted(self.series):
+                lines.extend(self.render_series(key, self.series[key]))
+        return lines
+
+    def render_series(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value))]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.series.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    # a value that is set, or read from a function each time the metrics are rendered,
+    # e.g. the depth of a queue
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def set_function(self, func, **labels):
+        self.set(func, **labels)
+
+    def render_series(self, key, value):
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                value = float('nan')
+        return Metric.render_series(self, key, value)
+
+class Timer:
+    # context manager that observes the seconds spent in its block, errors included
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.start = scheduler.monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe_key(self.key, scheduler.monotonic() - self.start)
+        return False
+
+class Histogram(Metric):
+    # cumulative bucket counts, sum and count per series, as Prometheus expects them
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.observe_key(self.key(labels), value)
+
+    def observe_key(self, key, value):
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        # with histogram.time(address=99): ...
+        return Timer(self, self.key(labels))
+
+    def snapshot(self, **labels):
+        # (bucket counts, sum, count) of one series, the last bucket is +Inf
+        with self.lock:
+            series = self.series.get(self.key(labels))
+            if series is None:
+                return [0] * (len(self.buckets) + 1), 0.0, 0
+            return list(series[0]), series[1], series[2]
+
+    def render_series(self, key, series):
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, key, [('le', format_value(bound))]),
+                                             cumulative))
+        lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), count))
+        return lines
+
+class Registry:
+    # The metric families of a process. Asking again for a name returns the family
+    # already registered, so modules can declare their metrics at import time.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, cls, name, help, labels, **options):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **options)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError("metric %s is already registered differently" % name)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # writes the metrics next to path and renames the file over it, so a reader
+        # never sees half of a dump
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+dump = REGISTRY.dump
+
+#
+#   HTTP endpoint
+#
+#   python metrics.py [port] serves the metrics of an empty registry, for testing;
+#   the polling scripts call serve() themselves
+#
+
+def serve(port=9108, registry=REGISTRY):
+    # serves /metrics from a daemon thread, returns the server or None when the port
+    # cannot be bound, the process keeps running without the endpoint
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Exporter(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass        # a scrape every few seconds would flood the console
+
+    try:
+        server = HTTPServer(('', port), Exporter)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Metrics endpoint unavailable on port %d (%s)\n" % (port, e))
+        return None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    if serve(int(sys.argv[1]) if len(sys.argv) > 1 else 9108) is not None:
+        while True:
+            time.sleep(1)
@@ -0,0 +1,107 @@
+import bisect     # keeps the per-metric sorted windows ordered
+import numpy
+
+#
+#   Rolling Statistics
+#
+
+class RollingStats:
+    # Fixed size rolling window over several metrics at once.
+    # Samples live in a preallocated ring buffer with one column per metric, so
+    # a new tick overwrites the oldest sample in place instead of growing and
+    # shrinking arrays. Sums are updated incrementally for the mean and variance,
+    # and a sorted copy of each column gives min, max and median without a sort.
+    # A NaN in a pushed row marks a failed reading and leaves that metric's
+    # window untouched.
+
+    def __init__(self, window, channels):
+        self.window = int(window)
+        self.channels = int(channels)
+        self.values = numpy.zeros((self.window, self.channels))     # ring buffer, one column per metric
+        self.head = numpy.zeros(self.channels, dtype=int)           # slot the next sample of each metric goes to
+        self.count = numpy.zeros(self.channels, dtype=int)          # samples currently held per metric
+        self.offset = numpy.zeros(self.channels)                    # first sample of each metric, keeps the sums small
+        self.total = numpy.zeros(self.channels)                     # sum of (sample - offset)
+        self.total_sq = numpy.zeros(self.channels)                  # sum of (sample - offset)^2
+        self.ordered = [[] for i in range(self.channels)]           # window of each metric in sorted order
+        self.updates = 0
+
+    def push(self, row):
+        # add one sample per metric, replacing the oldest one once the window is full
+        for c in range(self.channels):
+            x = float(row[c])
+            if x != x:  # NaN, failed reading
+                continue
+            ordered = self.ordered[c]
+            if self.count[c] == 0:
+                self.offset[c] = x
+            d = x - self.offset[c]
+            h = self.head[c]
+            if self.count[c] == self.window:
+                old = float(self.values[h, c])
+                del ordered[bisect.bisect_left(ordered, old)]
+                d_old = old - self.offset[c]
+                self.total[c] -= d_old
+                self.total_sq[c] -= d_old * d_old
+            else:
+                self.count[c] += 1
+            bisect.insort(ordered, x)
+            self.values[h, c] = x
+            self.total[c] += d
+            self.total_sq[c] += d * d
+            self.head[c] = (h + 1) % self.window
+
+        # the running sums pick up rounding error as samples come and go,
+        # rebuild them from the buffer once per window length
+        self.updates += 1
+        if self.updates >= self.window:
+            self.updates = 0
+            self._resum()
+
+    def _resum(self):
+        for c in range(self.channels):
+            n = self.count[c]
+            if n == 0:
+                continue
+            d = self.values[:n, c] - self.offset[c]
+            self.total[c] = d.sum()
+            self.total_sq[c] = numpy.dot(d, d)
+
+    def window_of(self, channel):
+        # samples of a metric from oldest to newest
+        n = self.count[channel]
+        if n < self.window:
+            return self.values[:n, channel]
+        h = self.head[channel]
+        return numpy.concatenate((self.values[h:, channel], self.values[:h, channel]))
+
+    def mean(self):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return self.offset + self.total / self.count
+
+    def var(self):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = self.total / self.count
+            return numpy.maximum(self.total_sq / self.count - mean * mean, 0.0)
+
+    def std(self):
+        return numpy.sqrt(self.var())
+
+    def min(self):
+        return numpy.array([o[0] if o else numpy.nan for o in self.ordered])
+
+    def max(self):
+        return numpy.array([o[-1] if o else numpy.nan for o in self.ordered])
+
+    def median(self):
+        result = numpy.empty(self.channels)
+        for c in range(self.channels):
+            o = self.ordered[c]
+            n = len(o)
+            if n == 0:
+                result[c] = numpy.nan
+            elif n % 2:
+                result[c] = o[n // 2]
+            else:
+                result[c] = (o[n // 2 - 1] + o[n // 2]) / 2.0
+        return result
@@ -0,0 +1,71 @@
+import warnings
+import numpy
+
+#
+#   Sample filtering
+#
+
+# quality flags of a metric in a sample, combined bitwise
+QUALITY_OK = 0
+QUALITY_MISSING = 1     # no reading, e.g. a failed read or an Atlas error status
+QUALITY_RANGE = 2       # outside the physical range of the metric
+QUALITY_SPIKE = 4       # rejected by the Hampel filter
+
+QUALITY_NAMES = [(QUALITY_MISSING, 'missing'), (QUALITY_RANGE, 'out of range'), (QUALITY_SPIKE, 'spike')]
+
+MAD_SIGMA = 1.4826      # scales the MAD to a standard deviation for normal noise
+
+class SampleFilter:
+    # Checks the sample row of every tick before it reaches the statistics, with array
+    # operations over all metrics at once. Values outside [low, high] and spikes become
+    # NaN and are flagged. A value is a spike when it is more than k standard deviations,
+    # estimated from the MAD, away from the median of the last window in-range values of
+    # its metric (Hampel filter). scale is a floor for that deviation so a metric that
+    # barely moves is not rejected for its last digit, None disables the spike check.
+    # The window keeps the spikes too, so a lasting change of level is accepted once it
+    # fills half of the window.
+
+    def __init__(self, low, high, scale, window=11, k=3.0, min_count=5):
+        channels = len(low)
+        self.low = numpy.array(low, dtype=float)
+        self.high = numpy.array(high, dtype=float)
+        self.scale = numpy.array([numpy.nan if s is None else s for s in scale], dtype=float)
+        self.check = ~numpy.isnan(self.scale)
+        self.k = k
+        self.min_count = min_count      # values needed in the window before spikes are rejected
+        self.values = numpy.full((window, channels), numpy.nan)
+        self.head = 0
+        self.quality = numpy.empty(channels, dtype=numpy.uint8)
+        self.flagged = dict([(flag, numpy.zeros(channels, dtype=numpy.int64)) for flag, name in QUALITY_NAMES])
+
+    def apply(self, sample):
+        # filters sample in place, returns the quality flags of its metrics
+        missing = numpy.isnan(sample)
+        with numpy.errstate(invalid='ignore'):
+            out_of_range = (sample < self.low) | (sample > self.high)
+        sample[out_of_range] = numpy.nan
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)     # metrics without values yet
+            median = numpy.nanmedian(self.values, axis=0)
+            mad = numpy.nanmedian(numpy.abs(self.values - median), axis=0)
+        count = numpy.count_nonzero(~numpy.isnan(self.values), axis=0)
+        limit = self.k * numpy.fmax(MAD_SIGMA * mad, self.scale)
+        with numpy.errstate(invalid='ignore'):
+            spike = self.check & (count >= self.min_count) & (numpy.abs(sample - median) > limit)
+        self.values[self.head] = sample
+        self.head = (self.head + 1) % len(self.values)
+        sample[spike] = numpy.nan
+
+        self.quality.fill(QUALITY_OK)
+        self.quality[missing] |= QUALITY_MISSING
+        self.quality[out_of_range] |= QUALITY_RANGE
+        self.quality[spike] |= QUALITY_SPIKE
+        self.flagged[QUALITY_MISSING] += missing
+        self.flagged[QUALITY_RANGE] += out_of_range
+        self.flagged[QUALITY_SPIKE] += spike
+        return self.quality
+
+def describe_quality(quality):
+    # "out of range, spike" for a set of flags
+    return ", ".join([name for flag, name in QUALITY_NAMES if quality & flag])
@@ -0,0 +1,177 @@
+import errno
+import fcntl
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+
+#
+#   Monotonic clock
+#
+
+try:
+    monotonic = time.monotonic          # python 3
+except AttributeError:
+    # python 2 has no monotonic clock, read CLOCK_MONOTONIC through librt
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long),
+                    ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+
+    def monotonic():
+        t = timespec()
+        if librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+#
+#   Wakeup
+#
+
+class Wakeup:
+    # A flag another thread sets to end a wait() early, like threading.Event. The wait
+    # sleeps in select() on a pipe, so the process only wakes when the flag is set or
+    # the timeout ends; python 2 implements Event.wait(timeout) by polling every few ms.
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'.')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:     # a full pipe is set already
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        # returns True when the flag is set, ctrl-c interrupts the wait
+        try:
+            readable = select.select([self.read_fd], [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:    # other signals end the wait early
+                raise
+            return False
+        return bool(readable)
+
+    def __del__(self):
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+#
+#   Scheduler
+#
+
+class Job:
+    def __init__(self, name, func, period, due):
+        self.name = name
+        self.func = func
+        self.period = period        # seconds, None for a job that runs once
+        self.due = due
+        self.cancelled = False
+        self.runs = 0
+        self.missed = 0             # periods skipped because the job was too late
+        self.max_late = 0.0         # seconds between the deadline and the start of a run
+        self.max_duration = 0.0
+
+class Scheduler:
+    # Runs jobs at fixed periods from a heap of deadlines on the monotonic clock, sleeping
+    # until the next one is due. A periodic job is rescheduled from its previous deadline,
+    # not from when it ran, so its period does not drift with the time its runs take.
+    # A job that falls a whole period or more behind skips the periods it missed instead
+    # of running them back to back, and the miss is reported through on_missed.
+    # Jobs run one at a time in the thread that called run().
+
+    def __init__(self, on_missed=None):
+        self.on_missed = on_missed or self.report_missed
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
+        self.thread = None          # the thread in run(), which needs no wakeup for its own jobs
+        self.heap = []
+        self.count = 0              # tie breaker, jobs due at once run in the order they were added
+        self.stopped = False
+
+    def schedule(self, job):
+        with self.lock:
+            self.count += 1
+            heapq.heappush(self.heap, (job.due, self.count, job))
+        if threading.current_thread() is not self.thread:
+            self.wakeup.set()       # the new deadline may come before the one being waited for
+        return job
+
+    def every(self, period, func, name=None, delay=0.0):
+        # runs func every period seconds, the first time after delay
+        return self.schedule(Job(name or func.__name__, func, period, monotonic() + delay))
+
+    def after(self, delay, func, name=None):
+        # runs func once, delay seconds from now
+        return self.schedule(Job(name or func.__name__, func, None, monotonic() + delay))
+
+    def cancel(self, job):
+        job.cancelled = True
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def report_missed(self, job, missed, late):
+        sys.stderr.write("%s missed %d run(s), %.2f s late\n" % (job.name, missed, late))
+
+    def run(self):
+        # runs jobs until stop(), exceptions of a job, ctrl-c included, end the loop
+        self.stopped = False
+        self.thread = threading.current_thread()
+        while not self.stopped:
+            with self.lock:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                due = self.heap[0][0] if self.heap else None
+                self.wakeup.clear()
+            now = monotonic()
+            if due is None or due > now:
+                # sleeps until the next deadline, or until another thread adds a job or stops
+                self.wakeup.wait(due - now if due is not None else None)
+                continue
+            with self.lock:
+                job = heapq.heappop(self.heap)[2]
+            if job.cancelled:
+                continue
+            late = now - job.due
+            if job.period is not None and late >= job.period:
+                missed = int(late // job.period)
+                job.missed += missed
+                job.due += missed * job.period
+                self.on_missed(job, missed, late)
+            job.max_late = max(job.max_late, now - job.due)
+            try:
+                job.func()
+            finally:
+                job.runs += 1
+                job.max_duration = max(job.max_duration, monotonic() - now)
+                if job.period is not None and not job.cancelled:
+                    job.due += job.period
+                    self.schedule(job)
+
+    def jobs(self):
+        with self.lock:
+            return sorted(set([entry[2] for entry in self.heap if not entry[2].cancelled]), key=lambda j: j.name)
@@ -1,130 +1,19 @@
 #!/usr/bin/python
 
-import io         # used to create file streams
-import fcntl      # used to access I2C parameters like addresses
+import sys
 import time       # used for sleep delay and timestamps
-import string     # helps parse strings
-import smbus
-import Adafruit_DHT
+import traceback
 import numpy
-
-#
-#   Atlas Scientific
-#
-
-class AtlasI2C:
-    long_timeout = 1.5         	# the timeout needed to query readings and calibrations
-    short_timeout = 0.5         	# timeout for regular commands
-    default_bus = 1         	# the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
-    default_address = 99     	# the default address for the sensor
-    current_addr = default_address
-        
-    def __init__(self, address=default_address, bus=default_bus):
-        # open two file streams, one for reading and one for writing
-        # the specific I2C channel is selected with bus
-        # it is usually 1, except for older revisions where its 0
-        # wb and rb indicate binary read and write
-        self.file_read = io.open("/dev/i2c-"+str(bus), "rb", buffering=0)
-        self.file_write = io.open("/dev/i2c-"+str(bus), "wb", buffering=0)
-                
-        # initializes I2C to either a user specified or default address
-        self.set_i2c_address(address)
-    
-    def set_i2c_address(self, addr):
-        # set the I2C communications to the slave specified by the address
-        # The commands for I2C dev using the ioctl functions are specified in
-        # the i2c-dev.h file from i2c-tools
-        I2C_SLAVE = 0x703
-        fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-        fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
-        self.current_addr = addr
-        
-    def write(self, cmd):
-        # appends the null character and sends the string over I2C
-        cmd += "\00"
-        self.file_write.write(cmd)
-        
-    def read(self, num_of_bytes=31):
-        # reads a specified number of bytes from I2C, then parses and displays the result
-        res = self.file_read.read(num_of_bytes)         # read from the board
-        response = filter(lambda x: x != '\x00', res)     # remove the null characters to get the response
-        if ord(response[0]) == 1:             # if the response isn't an error
-            # change MSB to 0 for all received characters except the first and get a list of characters
-            char_list = map(lambda x: chr(ord(x) & ~0x80), list(response[1:]))
-            # NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
-            if self.current_addr == 99: # pH sensor
-                return "pH: " + ''.join(char_list)     # convert the char list to a string and returns it
-            elif self.current_addr == 100: # EC sensor
-                temp_string=''.join(char_list)
-                #print 'EC: ' + string.split(temp_string, ",")[0]
-                #print 'TDS: ' + string.split(temp_string, ",")[1]
-                #print 'Salinity: ' + string.split(temp_string, ",")[2]
-                #return "Gravity: " + string.split(temp_string, ",")[3]     # convert the char list to a string and returns it
-                return "EC: " + string.split(temp_string, ",")[0] + "\nTDS: " + string.split(temp_string, ",")[1] + "\nSalinity: " + string.split(temp_string, ",")[2] + "\nGravity: " + string.split(temp_string, ",")[3]     # convert the char list to a string and returns it
-            elif self.current_addr == 102: # RTD sensor
-                return "Soluble Temperature: " + ''.join(char_list) + " C"     # convert the char list to a string and returns it
-        else:
-            return "Error " + str(ord(response[0]))
-    
-    def query(self, string):
-        # write a command to the board, wait the correct timeout, and read the response
-        self.write(string)
-            
-        # the read and calibration commands require a longer timeout
-        if((string.upper().startswith("R")) or
-            (string.upper().startswith("CAL"))):
-            time.sleep(self.long_timeout)
-        elif string.upper().startswith("SLEEP"):
-            return "sleep mode"
-        else:
-            time.sleep(self.short_timeout)
-                
-        return self.read()
-        
-    def close(self):
-        self.file_read.close()
-        self.file_write.close()
-        
-    def list_i2c_devices(self):
-        prev_addr = self.current_addr # save the current address so we can restore it after
-        i2c_devices = []
-        for i in range (0,128):
-            try:
-                self.set_i2c_address(i)
-                self.read()
-                i2c_devices.append(i)
-            except IOError:
-                pass
-        self.set_i2c_address(prev_addr) # restore the address we were using
-        return i2c_devices
-
-#
-#   BH1750
-#
-
-class BH1750():
-    # define constants
-    default_address = 0x23              # the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
-    default_bus = 1                     # the default address for the sensor
-    POWER_DOWN = 0x00                   # No active state
-    POWER_ON = 0x01                     # Power on
-    RESET = 0x07                        # Reset data register value
-    CONTINUOUS_LOW_RES_MODE = 0x13      # Start measurement at 4lx resolution. Time typically 16ms
-    CONTINUOUS_HIGH_RES_MODE_1 = 0x10   # Start measurement at 1lx resolution. Time typically 120ms
-    CONTINUOUS_HIGH_RES_MODE_2 = 0x11   # Start measurement at 0.5lx resolution. Time typically 120ms
-    ONE_TIME_HIGH_RES_MODE_1 = 0x20     # Start measurement at 1lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
-    ONE_TIME_HIGH_RES_MODE_2 = 0x21     # Start measurement at 0.5lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
-    ONE_TIME_LOW_RES_MODE = 0x23        # Start measurement at 1lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
-    
-    def __init__(self):
-        self.bus = smbus.SMBus(1)
-    
-    def convertToNumber(self, data):
-        return ((data[1]+(256*data[0]))/1.2)
-
-    def readLight(self, addr=default_address):
-        data=self.bus.read_i2c_block_data(addr,self.ONE_TIME_HIGH_RES_MODE_1)
-        return self.convertToNumber(data)
+import metrics
+from rolling_stats import RollingStats
+from uplink import TelemetryUplink, make_sink
+from sensor_store import SensorStore
+from scheduler import Scheduler
+from sample_filter import SampleFilter, describe_quality, QUALITY_MISSING, QUALITY_RANGE, QUALITY_SPIKE
+from dht_sampler import DHTSampler
+from light_sampler import LightSampler
+from i2c_discovery import I2CDiscovery, KNOWN_RANGE
+from shield_sensors import AtlasI2C, BH1750, format_reading, STAT_METRICS, ATLAS_COLUMNS
 
 #
 #   Main
@@ -134,172 +23,161 @@ class BH1750():
 def main():
     # Sensor Objects Definition
     device = AtlasI2C()             # Atlas Scientific sensors (ph,ec, rtd)
-    device1 = BH1750()              # BH1750 light sensor
-    device2 = Adafruit_DHT.DHT22    # DHT22 temperature and humidity sensor
-    pin = 24                        # DHT22 data pin
+    device1 = LightSampler(BH1750()) # BH1750 light sensor, sampled continuously in the background
+    device2 = DHTSampler(24)        # DHT22 temperature and humidity sensor on data pin 24, sampled in the background
+    dht_max_age = 30                # seconds a cached DHT22 reading stays valid
+    light_max_age = 5               # seconds a cached light reading stays valid
     gcp_timer = 1 * 60              # 5 minutes for GCP Pub/Sub
     poll_timer = 10                 # 10 seconds per sensor reading
+    atlas_timer = 10                # 10 seconds per Atlas reading (pH, EC, RTD)
+    atlas_max_age = 30              # seconds a cached Atlas reading stays valid
+    discovery = I2CDiscovery(AtlasI2C.default_bus, KNOWN_RANGE) # cached device map of the shield, only its addresses are probed
+    uplink_target = "http://127.0.0.1:8085/telemetry" # pubsub://<project>/<topic> for GCP, this URL is the stand-in in uplink.py
+    uplink_spool = "telemetry.spool" # batches waiting for the network
+    store_path = "sensor_store"     # local history of every reading, with 1 minute and 1 hour rollups
+    metrics_port = 9108             # Prometheus text at http://<pi>:9108/metrics
+    metrics_dump = "metrics.prom"   # the same text, rewritten every metrics_timer seconds
+    metrics_timer = 60
     
     
-    # initialize sensors (remove first light intensity error)
-    device1.readLight()
-    humidity, temperature = Adafruit_DHT.read_retry(device2, pin)
-    stat_dht22_temp = [float(temperature)] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    stat_dht22_humid = [float(humidity)] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    
-    device.set_i2c_address(99)  # (99 pH)
-    temp = device.query("R")
-    stat_atlas_ph = [float(string.split(temp, ": ")[1])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    device.set_i2c_address(100) # (100 EC)
-    temp = device.query("R")
-    temp1 = string.split(temp, ": ")[1] #EC
-    stat_atlas_ec = [float(string.split(temp1, "\n")[0])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    temp1 = string.split(temp, ": ")[2] #TDS
-    stat_atlas_tds = [float(string.split(temp1, "\n")[0])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    temp1 = string.split(temp, ": ")[3] #Salinity
-    stat_atlas_sal = [float(string.split(temp1, "\n")[0])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    temp1 = string.split(temp, ": ")[4] #Gravity
-    stat_atlas_gra = [float(string.split(temp1, "\n")[0])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    device.set_i2c_address(102) # (102 RTD)
-    temp = device.query("R")
-    temp = string.split(temp, ": ")[1]
-    stat_atlas_rtd = [float(string.split(temp, " C")[0])] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    stat_bh1750_lux = [float(str(device1.readLight()))] * ((gcp_timer/poll_timer)-1) # initialize local statistic
-    
-    # set up numpy arrays
-    stat_dht22_temp = numpy.array(stat_dht22_temp)
-    stat_dht22_humid = numpy.array(stat_dht22_humid)
-    stat_atlas_ph = numpy.array(stat_atlas_ph)
-    stat_atlas_ec = numpy.array(stat_atlas_ec)
-    stat_atlas_tds = numpy.array(stat_atlas_tds)
-    stat_atlas_sal = numpy.array(stat_atlas_sal)
-    stat_atlas_gra = numpy.array(stat_atlas_gra)
-    stat_atlas_rtd = numpy.array(stat_atlas_rtd)
-    stat_bh1750_lux = numpy.array(stat_bh1750_lux)
+    # initialize sensors
+    device1.start()
+    device2.start()
+    metrics.serve(metrics_port)
+    stat = RollingStats(gcp_timer/poll_timer, len(STAT_METRICS)) # local statistic over one GCP window
+    sample = numpy.empty(len(STAT_METRICS)) # readings of one tick, NaN marks a failed reading
+    uplink = TelemetryUplink(make_sink(uplink_target), [m[0] for m in STAT_METRICS], uplink_spool)
+    store = SensorStore(store_path, [m[0] for m in STAT_METRICS])
+    sample_filter = SampleFilter([m[2] for m in STAT_METRICS], [m[3] for m in STAT_METRICS],
+                                 [m[4] for m in STAT_METRICS]) # ranges and spikes, between the sensors and the statistic
+    # queue depths of the uplink and the rejected readings, read when the metrics are rendered
+    metrics.gauge('plantos_uplink_buffered_rows', "Readings waiting for the next batch").set_function(lambda: len(uplink.rows))
+    metrics.gauge('plantos_uplink_spooled_batches', "Batches written to the spool since start").set_function(lambda: uplink.spooled)
+    rejected = metrics.gauge('plantos_filter_flagged', "Readings flagged by the sample filter", ['metric', 'flag'])
+    for i in range(len(STAT_METRICS)):
+        for flag, flag_name in ((QUALITY_MISSING, 'missing'), (QUALITY_RANGE, 'range'), (QUALITY_SPIKE, 'spike')):
+            rejected.set_function(lambda flag=flag, i=i: sample_filter.flagged[flag][i], metric=STAT_METRICS[i][0], flag=flag_name)
     
     # main loop
     while True:
         input = raw_input("Enter command: ")
                 
         if input.upper().startswith("LIST_ADDR"):
-            devices = device.list_i2c_devices() # obtain I2C devices address that are connected to the shield
-            for i in range(len (devices)):
-                print devices[i]
+            devices = discovery.refresh() # obtain I2C devices that are connected to the shield, only new ones are identified
+            for addr in sorted(devices):
+                print("%d %s" % (addr, devices[addr]))
                 
         # continuous polling command automatically polls the board
         elif input.upper().startswith("POLL"):
-            # Setup sensor polling timer and GCP PubSub timer
-            poll_time = time.time()
-            gcp_time = time.time()
+            scheduler = Scheduler() # every job runs at its own period, on the monotonic clock
+            job_errors = metrics.counter('plantos_job_errors_total', "Exceptions raised by a polling job", ['job'])
+            
+            def guarded(func):
+                # a failing job is logged and counted, polling goes on with its next run
+                def job():
+                    try:
+                        func()
+                    except Exception:
+                        job_errors.inc(job=func.__name__)
+                        sys.stderr.write("%s failed\n%s" % (func.__name__, traceback.format_exc()))
+                job.__name__ = func.__name__
+                return job
+            # boards to poll, all read in one conversion window
+            atlas = {'devices': discovery.device_map(), 'time': None}
+            atlas['addresses'] = [addr for addr in discovery.atlas_addresses() if atlas['devices'][addr] in ATLAS_COLUMNS]
+            atlas_sample = numpy.empty(len(STAT_METRICS)) # latest Atlas readings, in the columns of the statistic
+            atlas_sample.fill(numpy.nan)
+            
+            def refresh_atlas():
+                # a board went away or changed, rebuild the device map
+                atlas['devices'] = discovery.refresh()
+                atlas['addresses'] = [addr for addr in discovery.atlas_addresses() if atlas['devices'][addr] in ATLAS_COLUMNS]
+            
+            # Atlas Task, the boards convert while the scheduler waits
+            def start_atlas():
+                try:
+                    scheduler.after(device.start_all(atlas['addresses']), guarded(collect_atlas))
+                except IOError:
+                    refresh_atlas()
+            
+            def collect_atlas():
+                try:
+                    readings = device.collect_all(atlas['addresses'], values=True)
+                except IOError:
+                    refresh_atlas()
+                    return
+                atlas_sample.fill(numpy.nan)
+                for reading in readings:
+                    print(format_reading(reading, atlas['devices'][reading.address]))
+                    columns = ATLAS_COLUMNS[atlas['devices'][reading.address]]
+                    if reading.status == 1 and len(reading.values) == len(columns):
+                        atlas_sample[columns] = reading.values
+                atlas['time'] = time.time()
+            
+            # Sensor Polling Task, one sample of the latest reading of every sensor
+            def poll():
+                poll_time = time.time()
+                sample.fill(numpy.nan)
+                humidity, temperature, age = device2.latest() # DHT22, never waits on the sensor
+                if humidity is not None and age <= dht_max_age:
+                    print('Ambient Temperature: {0:0.1f} C  \nAmbient Humidity: {1:0.1f} %'.format(temperature, humidity))
+                    sample[0] = temperature
+                    sample[1] = humidity
+                if atlas['time'] is not None and poll_time - atlas['time'] <= atlas_max_age:
+                    columns = ~numpy.isnan(atlas_sample)
+                    sample[columns] = atlas_sample[columns]
+                lux, age = device1.latest() # BH1750, averaged over the last samples
+                if lux is not None and age <= light_max_age:
+                    print 'Light Intensity: ' + str(lux) + ' lx'
+                    sample[8] = lux
+                else:
+                    print 'Failed to get reading BH1750. Try again!'
+                quality = sample_filter.apply(sample) # rejected readings become NaN
+                for i in numpy.flatnonzero(quality & ~QUALITY_MISSING):
+                    print 'Rejected ' + STAT_METRICS[i][0] + ' (' + describe_quality(quality[i]) + ')'
+                stat.push(sample) #local statistic
+                uplink.add(poll_time, sample)
+                store.append(poll_time, sample, quality)
+                # local statistic routine
+                print 'Local Statistic at ' + (time.strftime('%d/%m/%Y %H:%M:%S'))
+                mean = stat.mean()
+                for i in range(len(STAT_METRICS)):
+                    print '[Average] ' + STAT_METRICS[i][0] + ': ' + str(mean[i]) + STAT_METRICS[i][1]
+                median = stat.median()
+                for i in range(len(STAT_METRICS)):
+                    print '[Median] ' + STAT_METRICS[i][0] + ': ' + str(median[i]) + STAT_METRICS[i][1]
+            
+            # GCP Pub/Sub Task, one compressed batch per window
+            def upload():
+                uplink.flush()
+            
+            # Metrics Task, for units that are read through files rather than scraped
+            def dump_metrics():
+                metrics.dump(metrics_dump)
+            
+            scheduler.every(atlas_timer, guarded(start_atlas))
+            scheduler.every(poll_timer, guarded(poll), delay=AtlasI2C.long_timeout + 1) # after the first Atlas readings
+            scheduler.every(gcp_timer, guarded(upload), delay=gcp_timer)
+            scheduler.every(metrics_timer, guarded(dump_metrics), delay=metrics_timer)
+            # how late and how long each job runs, the cycle slows down where these grow
+            job_gauges = [metrics.gauge('plantos_job_runs', "Runs of a polling job", ['job']),
+                          metrics.gauge('plantos_job_missed', "Periods a polling job skipped", ['job']),
+                          metrics.gauge('plantos_job_max_late_seconds', "Longest delay of a polling job", ['job']),
+                          metrics.gauge('plantos_job_max_duration_seconds', "Longest run of a polling job", ['job'])]
+            for job in scheduler.jobs():
+                for gauge, attribute in zip(job_gauges, ('runs', 'missed', 'max_late', 'max_duration')):
+                    gauge.set_function(lambda job=job, attribute=attribute: getattr(job, attribute), job=job.name)
             try:
-                while True:
-                    # Sensor Polling Task
-                    if (time.time() - poll_time) >= poll_timer:
-                        # reset sensor poll timer
-                        poll_time = time.time()
-                        humidity = None
-                        temperature = None
-                        humidity, temperature = Adafruit_DHT.read_retry(device2, pin) # DHT22
-                        if humidity is not None and temperature is not None:
-                            print('Ambient Temperature: {0:0.1f} C  \nAmbient Humidity: {1:0.1f} %'.format(temperature, humidity))
-                            stat_dht22_temp = numpy.append(stat_dht22_temp, float(temperature)) #local statistic
-                            stat_dht22_humid = numpy.append(stat_dht22_humid, float(humidity)) #local statistic
-                        else:
-                            stat_dht22_temp = numpy.median(stat_dht22_temp)
-                            stat_dht22_humid = numpy.median(stat_dht22_humid)
-                        
-                        device.set_i2c_address(99)  # (99 pH)
-                        temp = device.query("R")
-                        print(temp)
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp, ": ")[1])
-                        if stat_temporary is not None:
-                            stat_atlas_ph = numpy.append(stat_atlas_ph, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_ph = numpy.median(stat_atlas_ph)
-                        device.set_i2c_address(100) # (100 EC)
-                        temp = device.query("R")
-                        print(temp)
-                        temp1 = string.split(temp, ": ")[1] #get EC
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp1, "\n")[0])
-                        if stat_temporary is not None:
-                            stat_atlas_ec = numpy.append(stat_atlas_ec, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_ec = numpy.median(stat_atlas_ec)
-                        temp1 = string.split(temp, ": ")[2] #get TDS
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp1, "\n")[0])
-                        if stat_temporary is not None:
-                            stat_atlas_tds = numpy.append(stat_atlas_tds, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_tds = numpy.median(stat_atlas_tds)
-                        temp1 = string.split(temp, ": ")[3] #get Salinity
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp1, "\n")[0])
-                        if stat_temporary is not None:
-                            stat_atlas_sal = numpy.append(stat_atlas_sal, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_sal = numpy.median(stat_atlas_sal)
-                        temp1 = string.split(temp, ": ")[4] #get Gravity
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp1, "\n")[0])
-                        if stat_temporary is not None:
-                            stat_atlas_gra = numpy.append(stat_atlas_gra, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_gra = numpy.median(stat_atlas_gra)
-                        device.set_i2c_address(102) # (102 RTD)
-                        temp = device.query("R")
-                        print(temp)
-                        temp = string.split(temp, ": ")[1]
-                        stat_temporary = None
-                        stat_temporary = float(string.split(temp, " C")[0])
-                        if stat_temporary is not None:
-                            stat_atlas_rtd = numpy.append(stat_atlas_rtd, stat_temporary) #local statistic
-                        else:
-                            stat_atlas_rtd = numpy.median(stat_atlas_rtd)
-                        temp = str(device1.readLight()) # BH1750
-                        print 'Light Intensity: ' + temp + ' lx'
-                        temp = float(temp)
-                        if temp is not None:
-                            stat_bh1750_lux = numpy.append(stat_bh1750_lux, temp) #local statistic
-                        else:
-                            stat_bh1750_lux = numpy.median(stat_bh1750_lux)
-                        # local statistic routine
-                        # compute mean
-                        print 'Local Statistic at ' + (time.strftime('%d/%m/%Y %H:%M:%S'))
-                        print '[Average] Ambient Temperature: ' + str(numpy.mean(stat_dht22_temp)) + ' C'
-                        print '[Average] Ambient Humidity: ' + str(numpy.mean(stat_dht22_humid)) + ' %'
-                        print '[Average] pH: ' + str(numpy.mean(stat_atlas_ph))
-                        print '[Average] EC: ' + str(numpy.mean(stat_atlas_ec))
-                        print '[Average] TDS: ' + str(numpy.mean(stat_atlas_tds))
-                        print '[Average] Salinity: ' + str(numpy.mean(stat_atlas_sal))
-                        print '[Average] Gravity: ' + str(numpy.mean(stat_atlas_gra))
-                        print '[Average] RTD: ' + str(numpy.mean(stat_atlas_rtd))
-                        print '[Average] Light Intensity: ' + str(numpy.mean(stat_bh1750_lux)) + ' lx'
-                        # compute median
-                        print '[Median] Ambient Temperature: ' + str(numpy.median(stat_dht22_temp)) + ' C'
-                        print '[Median] Ambient Humidity: ' + str(numpy.median(stat_dht22_humid)) + ' %'
-                        print '[Median] pH: ' + str(numpy.median(stat_atlas_ph))
-                        print '[Median] EC: ' + str(numpy.median(stat_atlas_ec))
-                        print '[Median] TDS: ' + str(numpy.median(stat_atlas_tds))
-                        print '[Median] Salinity: ' + str(numpy.median(stat_atlas_sal))
-                        print '[Median] Gravity: ' + str(numpy.median(stat_atlas_gra))
-                        print '[Median] RTD: ' + str(numpy.median(stat_atlas_rtd))
-                        print '[Median] Light Intensity: ' + str(numpy.median(stat_bh1750_lux)) + ' lx'
-                        # truncate local statistic arrays
-                        stat_dht22_temp = numpy.delete(stat_dht22_temp, 0)
-                        stat_dht22_humid = numpy.delete(stat_dht22_humid, 0)
-                        stat_atlas_ph = numpy.delete(stat_atlas_ph, 0)
-                        stat_atlas_ec = numpy.delete(stat_atlas_ec, 0)
-                        stat_atlas_tds = numpy.delete(stat_atlas_tds, 0)
-                        stat_atlas_sal = numpy.delete(stat_atlas_sal, 0)
-                        stat_atlas_gra = numpy.delete(stat_atlas_gra, 0)
-                        stat_atlas_rtd = numpy.delete(stat_atlas_rtd, 0)
-                        stat_bh1750_lux = numpy.delete(stat_bh1750_lux, 0)
-                    else:
-                        time.sleep(0.50) #sleep 500ms
+                scheduler.run()
             except KeyboardInterrupt: 		# catches the ctrl-c command, which breaks the loop above
+                    store.flush()
+                    for job in scheduler.jobs():
+                        print("%s: %d runs, %d missed, %.3f s max late, %.3f s max duration" % (
+                            job.name, job.runs, job.missed, job.max_late, job.max_duration))
+                    for i in range(len(STAT_METRICS)):
+                        print("%s: %d missing, %d out of range, %d spikes" % (STAT_METRICS[i][0],
+                            sample_filter.flagged[QUALITY_MISSING][i], sample_filter.flagged[QUALITY_RANGE][i],
+                            sample_filter.flagged[QUALITY_SPIKE][i]))
                     print("Continuous polling stopped")
                         
         # if not a special keyword, pass commands straight to board
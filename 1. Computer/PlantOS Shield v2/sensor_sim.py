@@ -0,0 +1,493 @@
+#!/usr/bin/python
+
+import argparse
+import errno
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy
+from dht_sampler import DHTSampler
+from i2c_bus import I2CBus
+from uplink import decode_batch
+import scheduler
+
+# the dataset loader lives with the Data Processing Engine
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', '..', '3. Data Processing Engine'))
+import sensor_dataset
+
+DEFAULT_DATASET = os.path.join(HERE, '..', '..', 'Public Datasets', 'time-series-sensor-data',
+                               'cityfarm-serdang-my-CityFarm-CFP0022.csv')
+
+#
+#   Simulated clock
+#
+
+real_time = time.time
+real_sleep = time.sleep
+EventType = type(threading.Event())
+real_wait = EventType.wait
+real_monotonic = scheduler.monotonic
+real_wakeup_wait = scheduler.Wakeup.wait
+main_thread = threading.current_thread()
+
+class SimClock:
+    # Simulated time running speed times faster than the wall clock. install() routes
+    # time.time, time.sleep, Event.wait and the scheduler clock and wakeup through it, so
+    # the polling scripts, the samplers and the uplink backoff all run on compressed time
+    # without changes. Once the deadline has passed, a sleep or wait of the main thread raises
+    # KeyboardInterrupt, which ends a POLL loop the same way ctrl-c does.
+
+    def __init__(self, speed=1.0, start=None, deadline=None):
+        self.speed = float(speed)
+        self.real_start = real_time()
+        self.start = self.real_start if start is None else start
+        self.deadline = deadline
+
+    def time(self):
+        return self.start + (real_time() - self.real_start) * self.speed
+
+    def sleep(self, seconds):
+        real_sleep(max(seconds, 0) / self.speed)
+        self.check_deadline()
+
+    def wait(self, event, timeout=None, wait=real_wait):
+        if timeout is not None:
+            timeout = max(timeout, 0) / self.speed
+        flag = wait(event, timeout)
+        self.check_deadline()
+        return flag
+
+    def check_deadline(self):
+        if (self.deadline is not None and self.time() >= self.deadline and
+                threading.current_thread() is main_thread):
+            raise KeyboardInterrupt
+
+    def install(self):
+        clock = self
+        time.time = self.time
+        time.sleep = self.sleep
+        EventType.wait = lambda event, timeout=None: clock.wait(event, timeout)
+        scheduler.monotonic = self.time     # simulated time never steps, so it is monotonic
+        scheduler.Wakeup.wait = lambda wakeup, timeout=None: clock.wait(wakeup, timeout, real_wakeup_wait)
+
+    def uninstall(self):
+        time.time = real_time
+        time.sleep = real_sleep
+        EventType.wait = real_wait
+        scheduler.monotonic = real_monotonic
+        scheduler.Wakeup.wait = real_wakeup_wait
+
+#
+#   Dataset replay
+#
+
+class Replay:
+    # Values of dataset columns at a simulated time. The dataset plays from its first
+    # record at the start of the simulation and loops at its end; a value missing
+    # from a record is carried forward from the last record that had it.
+
+    def __init__(self, path=DEFAULT_DATASET, start=0.0):
+        self.data = sensor_dataset.load(path)
+        timestamps = self.data['timestamp']
+        self.first = timestamps[0]
+        self.span = timestamps[-1] - timestamps[0]
+        self.start = start
+        self.valid = {}
+
+    def values(self, columns, now):
+        offset = (now - self.start) % self.span if self.span > 0 else 0.0
+        row = max(numpy.searchsorted(self.data['timestamp'], self.first + offset, 'right') - 1, 0)
+        values = []
+        for name in columns:
+            if name not in self.valid:
+                self.valid[name] = numpy.flatnonzero(~numpy.isnan(self.data[name]))
+            valid = self.valid[name]
+            i = max(numpy.searchsorted(valid, row, 'right') - 1, 0)
+            values.append(float(self.data[name][valid[i]]))
+        return values
+
+#
+#   Simulated devices
+#
+
+# boards on the shield: address -> (type, dataset columns in reply order)
+ATLAS_BOARDS = {99: ('pH', ['PH']),
+                100: ('EC', ['EC', 'TDS', 'Sal', 'GRV']),
+                102: ('RTD', ['Temp'])}
+
+class SimAtlas:
+    # An EZO board. A command is answered once its processing delay has passed, a read
+    # before that returns status 254 and a read with nothing pending returns 255. Replies
+    # are framed like the real boards as seen by the Pi: status byte, characters with
+    # the MSB set, null terminated and padded to the read length.
+
+    read_delay = 0.9            # "R" and calibration
+    command_delay = 0.3         # every other command
+
+    def __init__(self, kind, columns, replay, error_rate=0.0):
+        self.kind = kind
+        self.columns = columns
+        self.replay = replay
+        self.error_rate = error_rate    # share of readings answered with status 2
+        self.reply = None
+        self.ready = 0.0
+        self.readings = 0
+        self.busy_reads = 0
+
+    def command(self, data, now):
+        cmd = bytearray(data).rstrip(b'\x00').decode('ascii')
+        upper = cmd.upper()
+        delay = self.command_delay
+        if upper.startswith('SLEEP'):
+            self.reply = None
+            return
+        elif upper.startswith('R'):
+            delay = self.read_delay
+            self.readings += 1
+            if random.random() < self.error_rate:
+                self.reply = (2, '')
+            else:
+                self.reply = (1, ','.join(['%g' % v for v in self.replay.values(self.columns, now)]))
+        elif upper.startswith('CAL'):
+            delay = self.read_delay
+            self.reply = (1, '')
+        elif upper == 'I':
+            self.reply = (1, '?I,%s,2.0' % self.kind)
+        elif upper == 'STATUS':
+            self.reply = (1, '?STATUS,P,5.00')
+        elif cmd:
+            self.reply = (1, '')
+        else:
+            self.reply = (2, '')
+        self.ready = now + delay
+
+    def response(self, length, now):
+        if self.reply is None:
+            data = bytearray([255])
+        elif now < self.ready:
+            data = bytearray([254])
+            self.busy_reads += 1
+        else:
+            status, text = self.reply
+            self.reply = None
+            data = bytearray([status]) + bytearray([ord(c) | 0x80 for c in text])
+        data += bytearray(max(length - len(data), 0))
+        return bytes(data[:length])
+
+class SimBH1750:
+    # A BH1750 whose result register is only updated by completed conversions, so a
+    # read that comes too early returns the previous result, as on the real chip.
+
+    HIGH_RES_2 = (0x11, 0x21)
+    LOW_RES = (0x13, 0x23)
+    ONE_TIME = (0x20, 0x21, 0x23)
+
+    def __init__(self, light):
+        self.light = light          # lux at a simulated time
+        self.mode = None
+        self.started = 0.0
+        self.count = 0
+
+    def command(self, data, now):
+        for op in bytearray(data):
+            if op == 0x00:          # power down
+                self.mode = None
+            elif op in (0x10, 0x11, 0x13, 0x20, 0x21, 0x23):
+                self.update(now)
+                self.mode = op
+                self.started = now
+
+    def conversion_time(self):
+        return 0.016 if self.mode in self.LOW_RES else 0.12
+
+    def update(self, now):
+        if self.mode is None or now - self.started < self.conversion_time():
+            return
+        lux = self.light(now)
+        if self.mode in self.HIGH_RES_2:
+            count = int(lux * 2.4)
+        elif self.mode in self.LOW_RES:
+            count = int(lux * 1.2) & ~3
+        else:
+            count = int(lux * 1.2)
+        self.count = min(max(count, 0), 65535)
+        if self.mode in self.ONE_TIME:
+            self.mode = None
+
+    def response(self, length, now):
+        self.update(now)
+        data = bytearray([self.count >> 8, self.count & 0xff])
+        data += bytearray(max(length - len(data), 0))
+        return bytes(data[:length])
+
+class SimDHT:
+    # DHT22 stand-in with a daily temperature and humidity swing, a share of the reads
+    # fails like on the real sensor
+    def __init__(self, clock, failure_rate=0.1, utc_offset=8):
+        self.clock = clock
+        self.failure_rate = failure_rate
+        self.utc_offset = utc_offset
+        self.reads = 0
+        self.failures = 0
+
+    def read(self, sensor, pin):
+        self.reads += 1
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return None, None
+        hour = ((self.clock.time() / 3600.0) + self.utc_offset) % 24
+        swing = math.cos(2 * math.pi * (hour - 14) / 24)     # warmest at 2pm
+        return 75 - 12 * swing + random.gauss(0, 1), 28 + 4 * swing + random.gauss(0, 0.2)
+
+#
+#   Simulated bus
+#
+
+class SimTCA9548A:
+    # channel register of a multiplexer, the bus routes to the devices behind the
+    # channels it enables
+    def __init__(self):
+        self.mask = 0
+        self.selects = 0
+
+    def command(self, data, now):
+        data = bytearray(data)
+        if data:
+            self.mask = data[-1]
+            self.selects += 1
+
+    def response(self, length, now):
+        return bytes(bytearray([self.mask]) + bytearray(length - 1))
+
+class SimI2CBus(I2CBus):
+    # Drop-in I2CBus with simulated devices attached by address, upstream or behind a
+    # channel of a SimTCA9548A. Transactions to absent addresses fail like a NAK, and a
+    # share of all transactions can be made to fail or to time out.
+
+    def __init__(self, clock, bus=1, error_rate=0.0, timeout_rate=0.0, timeout=1.0):
+        self.bus = bus
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.mux_selected = None
+        self.devices = {}
+        self.channels = {}          # (multiplexer address, channel) -> {address: device}
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout      # simulated seconds a timed out transaction blocks
+        self.transactions = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def attach(self, addr, device, mux=None, channel=None):
+        if mux is None:
+            self.devices[addr] = device
+        else:
+            if mux not in self.devices:
+                self.devices[mux] = SimTCA9548A()
+            self.channels.setdefault((mux, channel), {})[addr] = device
+
+    def device(self, addr):
+        # the device answering at addr with the current multiplexer settings
+        device = self.devices.get(addr)
+        if device is not None:
+            return device
+        for (mux, channel), devices in self.channels.items():
+            if addr in devices and self.devices[mux].mask & (1 << channel):
+                return devices[addr]
+        return None
+
+    def raw_transfer(self, *messages):
+        with self.lock:
+            self.transactions += 1
+            r = random.random()
+            if r < self.timeout_rate:
+                self.timeouts += 1
+                real_sleep(self.timeout / self.clock.speed)
+                raise IOError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+            if r < self.timeout_rate + self.error_rate:
+                self.errors += 1
+                raise IOError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+            now = self.clock.time()
+            results = []
+            for addr, data, length in messages:
+                device = self.device(addr)
+                if device is None:
+                    raise IOError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+                if length:
+                    results.append(device.response(length, now))
+                else:
+                    device.command(data, now)
+            return results
+
+    def quick(self, addr):
+        with self.lock:
+            return self.device(addr) is not None
+
+    def close(self):
+        with self.buses_lock:
+            if self.buses.get(self.bus) is self:
+                del self.buses[self.bus]
+
+#
+#   Simulated shield
+#
+
+class Simulator:
+    # The shield on a simulated bus: pH, EC and RTD boards replaying the dataset, a
+    # BH1750 under a day/night light cycle and a DHT22. add_rack() puts another set of
+    # boards and a BH1750 behind a multiplexer channel. install() puts it in place of
+    # the hardware for every driver created afterwards.
+
+    def __init__(self, dataset=DEFAULT_DATASET, speed=1.0, bus=1, error_rate=0.0, timeout_rate=0.0,
+                 reply_error_rate=0.0, dht_failure_rate=0.1, peak_lux=32000.0, utc_offset=8):
+        self.clock = SimClock(speed)
+        self.replay = Replay(dataset, self.clock.start)
+        self.bus = SimI2CBus(self.clock, bus, error_rate, timeout_rate)
+        self.reply_error_rate = reply_error_rate
+        self.boards = []
+        self.add_rack()
+        self.dht = SimDHT(self.clock, dht_failure_rate, utc_offset)
+        self.peak_lux = peak_lux
+        self.utc_offset = utc_offset
+
+    def add_rack(self, mux=None, channel=None):
+        # Atlas boards and a BH1750 at their default addresses, upstream or behind a channel
+        for addr in ATLAS_BOARDS:
+            kind, columns = ATLAS_BOARDS[addr]
+            board = SimAtlas(kind, columns, self.replay, self.reply_error_rate)
+            self.boards.append(board)
+            self.bus.attach(addr, board, mux, channel)
+        self.bus.attach(0x23, SimBH1750(self.light), mux, channel)
+
+    def light(self, now):
+        # grow lights on from 6am to 10pm, ramping over the first and last hour
+        hour = ((now / 3600.0) + self.utc_offset) % 24
+        level = min(max(min(hour - 6, 22 - hour), 0), 1)
+        return max(self.peak_lux * level * random.gauss(1, 0.02), 0)
+
+    def install(self):
+        self.clock.install()
+        I2CBus.register(self.bus.bus, self.bus)
+        DHTSampler.backend = (self.dht.read, 22)
+
+    def uninstall(self):
+        DHTSampler.backend = None
+        self.bus.close()
+        self.clock.uninstall()
+
+#
+#   Soak test
+#
+#   python sensor_sim.py [--hours H] [--speed X] [--error-rate P] ...
+#   runs a polling script against the simulator and reports what went through it
+#
+
+class SimSink:
+    # uplink sink that decodes and counts batches, failing a share of them so the
+    # spool and replay path is exercised
+    def __init__(self, failure_rate=0.0):
+        self.failure_rate = failure_rate
+        self.batches = 0
+        self.rows = 0
+        self.bytes = 0
+        self.failures = 0
+
+    def send(self, payload):
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise IOError("simulated uplink failure")
+        device_id, fields, timestamps, values = decode_batch(payload)
+        self.batches += 1
+        self.rows += len(timestamps)
+        self.bytes += len(payload)
+
+def soak(hours=24.0, speed=100.0, script='sensor_polling_stat', commands=('POLL',),
+         uplink_failure_rate=0.0, verbose=False, **options):
+    # runs main() of a polling script for the given simulated time, feeding it the
+    # commands in place of the keyboard, returns a report of the run
+    sim = Simulator(speed=speed, **options)
+    sink = SimSink(uplink_failure_rate)
+    workdir = tempfile.mkdtemp(prefix='plantos-soak-')
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    pending = list(commands)
+
+    def feed(prompt=''):
+        if not pending:
+            raise EOFError
+        return pending.pop(0)
+
+    sim.install()
+    sim.clock.deadline = sim.clock.time() + hours * 3600
+    start = real_time()
+    try:
+        module = __import__(script)
+        module.raw_input = feed
+        if hasattr(module, 'make_sink'):
+            module.make_sink = lambda target: sink
+        os.chdir(workdir)       # the uplink spool is written to the working directory
+        if not verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            module.main()
+        except EOFError:
+            pass
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        elapsed = real_time() - start
+        simulated = sim.clock.time() - sim.clock.start
+        for thread in threading.enumerate():     # samplers started by the script
+            if thread.daemon and hasattr(thread, 'stop'):
+                thread.stop()
+                thread.join()
+        sim.uninstall()
+        spooled = sum([os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir)
+                       if f.endswith('.spool')])
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'simulated_hours': simulated / 3600.0,
+            'real_seconds': elapsed,
+            'speed': simulated / elapsed if elapsed else 0.0,
+            'bus_transactions': sim.bus.transactions,
+            'bus_errors': sim.bus.errors,
+            'bus_timeouts': sim.bus.timeouts,
+            'atlas_readings': sum([b.readings for b in sim.boards]),
+            'atlas_busy_reads': sum([b.busy_reads for b in sim.boards]),
+            'dht_reads': sim.dht.reads,
+            'dht_failures': sim.dht.failures,
+            'uplink_batches': sink.batches,
+            'uplink_rows': sink.rows,
+            'uplink_bytes': sink.bytes,
+            'uplink_failures': sink.failures,
+            'spool_bytes_left': spooled}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Soak test a polling script on the simulated shield")
+    parser.add_argument('--hours', type=float, default=24.0, help="simulated hours to run")
+    parser.add_argument('--speed', type=float, default=100.0, help="time compression factor")
+    parser.add_argument('--script', default='sensor_polling_stat', help="polling script to run")
+    parser.add_argument('--command', action='append', help="command to enter, default POLL")
+    parser.add_argument('--dataset', default=DEFAULT_DATASET, help="dataset the Atlas boards replay")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of failing I2C transactions")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="share of timed out I2C transactions")
+    parser.add_argument('--reply-error-rate', type=float, default=0.0, help="share of Atlas readings with status 2")
+    parser.add_argument('--dht-failure-rate', type=float, default=0.1, help="share of failing DHT22 reads")
+    parser.add_argument('--uplink-failure-rate', type=float, default=0.0, help="share of failing uploads")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the script")
+    args = parser.parse_args()
+
+    report = soak(args.hours, args.speed, args.script, args.command or ['POLL'], args.uplink_failure_rate,
+                  args.verbose, dataset=args.dataset, error_rate=args.error_rate,
+                  timeout_rate=args.timeout_rate, reply_error_rate=args.reply_error_rate,
+                  dht_failure_rate=args.dht_failure_rate)
+    for key in sorted(report):
+        print("%s: %s" % (key, report[key]))
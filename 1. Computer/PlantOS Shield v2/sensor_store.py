@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+import numpy
+
+#
+#   Local time-series store
+#
+#   <path>/meta.json            field names, in column order
+#   <path>/raw/<start>.seg      one record per tick: float64 timestamp, float32 per field,
+#                               then a quality byte per field (see sample_filter)
+#   <path>/1min/<start>.seg     one record per minute: timestamp, then the mean, min,
+#   <path>/1hour/<start>.seg    max and count of every field, the same per hour
+#
+#   Segments cover fixed, aligned spans of time and are only ever appended to, in one
+#   write per flush. Retention deletes whole segments, so nothing on the SD card is
+#   rewritten. Reads memory map the segments a query overlaps.
+#
+
+# (name, bucket seconds, segment span seconds, retention seconds), raw has no bucket
+TIERS = [('raw', 0, 86400, 14 * 86400),                 # ~460 KB a day at one tick per 10 s
+         ('1min', 60, 7 * 86400, 90 * 86400),           # ~190 KB a day
+         ('1hour', 3600, 365 * 86400, 5 * 365 * 86400)] # ~3 KB a day
+
+def raw_dtype(fields):
+    return numpy.dtype([('timestamp', '<f8'), ('values', '<f4', (len(fields),)), ('quality', 'u1', (len(fields),))])
+
+def rollup_dtype(fields):
+    n = len(fields)
+    return numpy.dtype([('timestamp', '<f8'), ('mean', '<f4', (n,)), ('min', '<f4', (n,)),
+                        ('max', '<f4', (n,)), ('count', '<u2', (n,))])
+
+class Segments:
+    # the segment files of one tier and the records waiting to be written to them
+    def __init__(self, path, dtype, span, retention):
+        self.path = path
+        self.dtype = dtype
+        self.span = span
+        self.retention = retention
+        self.pending = []
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        starts = self.starts()
+        if starts:
+            # a record cut short by a power loss would misalign everything appended after it
+            last = self.file(starts[-1])
+            size = os.path.getsize(last)
+            if size % dtype.itemsize:
+                with open(last, 'r+b') as f:
+                    f.truncate(size - size % dtype.itemsize)
+
+    def file(self, start):
+        return os.path.join(self.path, '%d.seg' % start)
+
+    def starts(self):
+        return sorted([int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg')])
+
+    def map(self, start):
+        rows = os.path.getsize(self.file(start)) // self.dtype.itemsize
+        if rows == 0:
+            return None
+        return numpy.memmap(self.file(start), dtype=self.dtype, mode='r', shape=(rows,))
+
+    def last(self):
+        # the newest record on disk or waiting, None when the tier is empty
+        if self.pending:
+            return self.pending[-1][0]
+        for start in reversed(self.starts()):
+            data = self.map(start)
+            if data is not None:
+                return numpy.array(data[-1:])[0]
+        return None
+
+    def add(self, record):
+        self.pending.append(record)
+
+    def flush(self):
+        # appends the waiting records, one write per segment they fall into
+        if not self.pending:
+            return
+        records = numpy.concatenate(self.pending)
+        self.pending = []
+        segment = (records['timestamp'] // self.span).astype(numpy.int64) * self.span
+        for start in numpy.unique(segment):
+            with open(self.file(start), 'ab') as f:
+                f.write(records[segment == start].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+    def expire(self, now):
+        for start in self.starts():
+            if start + self.span <= now - self.retention:
+                os.remove(self.file(start))
+
+    def read(self, start=None, end=None):
+        # records with start <= timestamp < end, oldest first
+        parts = []
+        for first in self.starts():
+            if (end is not None and first >= end) or (start is not None and first + self.span <= start):
+                continue
+            data = self.map(first)
+            if data is not None:
+                parts.append(numpy.array(self.slice(data, start, end)))
+        if self.pending:
+            parts.append(self.slice(numpy.concatenate(self.pending), start, end))
+        if not parts:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.concatenate(parts)
+
+    def slice(self, data, start, end):
+        t = data['timestamp']
+        lo = 0 if start is None else numpy.searchsorted(t, start, 'left')
+        hi = len(t) if end is None else numpy.searchsorted(t, end, 'left')
+        return data[lo:hi]
+
+class Rollup:
+    # running mean, min, max and count of the fields over one bucket, NaN values skipped
+    def __init__(self, segments, bucket, channels):
+        self.segments = segments
+        self.bucket = bucket
+        self.start = None
+        self.total = numpy.zeros(channels)
+        self.low = numpy.empty(channels)
+        self.high = numpy.empty(channels)
+        self.count = numpy.zeros(channels, dtype=numpy.int64)
+        self.reset()
+
+    def reset(self):
+        self.total.fill(0)
+        self.low.fill(numpy.inf)
+        self.high.fill(-numpy.inf)
+        self.count.fill(0)
+
+    def add(self, timestamp, row):
+        start = timestamp // self.bucket * self.bucket
+        if self.start is not None and start != self.start:
+            self.emit()
+        self.start = start
+        valid = ~numpy.isnan(row)
+        self.count += valid
+        self.total += numpy.where(valid, row, 0)
+        numpy.fmin(self.low, row, out=self.low)
+        numpy.fmax(self.high, row, out=self.high)
+
+    def emit(self):
+        record = numpy.zeros(1, dtype=self.segments.dtype)
+        empty = self.count == 0
+        record['timestamp'] = self.start
+        record['mean'] = numpy.where(empty, numpy.nan, self.total / numpy.maximum(self.count, 1))
+        record['min'] = numpy.where(empty, numpy.nan, self.low)
+        record['max'] = numpy.where(empty, numpy.nan, self.high)
+        record['count'] = numpy.minimum(self.count, 65535)
+        self.segments.add(record)
+        self.reset()
+
+class SensorStore:
+    # Append-only store of the readings of every polling tick with 1-minute and 1-hour
+    # rollups. Records are buffered and written every flush_interval seconds. A rollup
+    # bucket is written once it is complete; the bucket in progress is rebuilt from the
+    # raw records when the store is opened again. Timestamps must not go backwards, a
+    # record older than the previous one is rejected.
+
+    def __init__(self, path, fields, flush_interval=60, tiers=TIERS):
+        self.path = path
+        self.fields = list(fields)
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['fields'] != self.fields:
+                raise ValueError("store %s holds fields %s" % (path, ', '.join(meta['fields'])))
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump({'fields': self.fields}, f)
+        self.tiers = {}
+        self.rollups = []
+        for name, bucket, span, retention in tiers:
+            dtype = rollup_dtype(self.fields) if bucket else raw_dtype(self.fields)
+            self.tiers[name] = Segments(os.path.join(path, name), dtype, span, retention)
+            if bucket:
+                self.rollups.append(Rollup(self.tiers[name], bucket, len(self.fields)))
+        self.raw = self.tiers[tiers[0][0]]
+        self.flushed = time.time()
+        last = self.raw.last()
+        self.last_time = last['timestamp'] if last is not None else None
+        self.recover()
+
+    def recover(self):
+        # feeds the raw records newer than the last bucket of each rollup back into it
+        for rollup in self.rollups:
+            last = rollup.segments.last()
+            start = last['timestamp'] + rollup.bucket if last is not None else None
+            for record in self.raw.read(start):
+                rollup.add(record['timestamp'], record['values'])
+
+    def append(self, timestamp, row, quality=None):
+        with self.lock:
+            if self.last_time is not None and timestamp < self.last_time:
+                return False
+            self.last_time = timestamp
+            record = numpy.zeros(1, dtype=self.raw.dtype)
+            record['timestamp'] = timestamp
+            record['values'] = row
+            if quality is not None:
+                record['quality'] = quality
+            self.raw.add(record)
+            for rollup in self.rollups:
+                rollup.add(timestamp, record['values'][0])
+            if time.time() - self.flushed >= self.flush_interval:
+                self.flush()
+            return True
+
+    def flush(self):
+        with self.lock:
+            self.flushed = time.time()
+            for tier in self.tiers.values():
+                tier.flush()
+                if self.last_time is not None:
+                    tier.expire(self.last_time)
+
+    def query(self, start=None, end=None, tier='raw'):
+        # structured array of the records with start <= timestamp < end, fields as in
+        # raw_dtype or rollup_dtype
+        with self.lock:
+            return self.tiers[tier].read(start, end)
+
+    def latest(self, seconds, tier='raw'):
+        # the records of the last seconds before the newest one
+        with self.lock:
+            if self.last_time is None:
+                return self.tiers[tier].read(0, 0)
+            return self.tiers[tier].read(self.last_time - seconds)
+
+    def column(self, records, field, stat='values'):
+        # one field of query results, e.g. column(store.query(tier='1hour'), 'pH', 'mean')
+        return records[stat][:, self.fields.index(field)]
+
+    def close(self):
+        self.flush()
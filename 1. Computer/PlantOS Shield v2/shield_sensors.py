@@ -0,0 +1,226 @@
+import time       # used for sleep delay and timestamps
+import string     # helps parse strings
+from collections import namedtuple
+from i2c_bus import I2CBus
+import metrics
+
+ATLAS_QUERY_SECONDS = metrics.histogram('plantos_atlas_query_seconds', "Atlas command to reply, waits included", ['address'])
+ATLAS_REPLIES = metrics.counter('plantos_atlas_replies_total', "Atlas readings by reply status (1 ok, 2 failed, 254 busy, 255 no data)",
+                                ['address', 'status'])
+BH1750_READ_SECONDS = metrics.histogram('plantos_bh1750_read_seconds', "BH1750 reads, one-shot conversions included", ['address'])
+
+#
+#   Atlas Scientific
+#
+
+# decoded reply of an Atlas board, values holds the fields its type lists in ATLAS_FIELDS
+AtlasReading = namedtuple('AtlasReading', ['address', 'status', 'values'])
+
+# fields and units returned for the "R" command by each type of board, as reported
+# by the "I" command that discovery sends, in reply order
+ATLAS_FIELDS = {'pH': (('pH', ''),),
+                'EC': (('EC', ''), ('TDS', ''), ('Salinity', ''), ('Gravity', '')),
+                'RTD': (('Soluble Temperature', ' C'),),
+                'DO': (('Dissolved Oxygen', ' mg/L'),),
+                'ORP': (('ORP', ' mV'),)}
+
+def format_reading(reading, kind=None):
+    # human readable form of an AtlasReading of a board of type kind, as printed by the
+    # polling loops; replies of other types or with other fields are listed as they are
+    if reading.status != 1:
+        return "Error " + str(reading.status)
+    fields = ATLAS_FIELDS.get(kind)
+    if fields is None or len(fields) != len(reading.values):
+        return "%s: %s" % (kind or reading.address, ",".join(["%g" % v for v in reading.values]))
+    return "\n".join(["%s: %g%s" % (fields[i][0], reading.values[i], fields[i][1]) for i in range(len(fields))])
+
+class AtlasI2C:
+    long_timeout = 1.5         	# the timeout needed to query readings and calibrations
+    short_timeout = 0.5         	# timeout for regular commands
+    default_bus = 1         	# the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
+    default_address = 99     	# the default address for the sensor
+    current_addr = default_address
+        
+    def __init__(self, address=default_address, bus=default_bus):
+        # every handle on a bus shares its I2CBus, the specific I2C channel is selected
+        # with bus, it is usually 1, except for older revisions where its 0
+        self.bus = I2CBus.get(bus)
+                
+        # initializes I2C to either a user specified or default address
+        self.set_i2c_address(address)
+    
+    def set_i2c_address(self, addr):
+        # set the slave used by the following commands, the address travels with
+        # every transaction so no ioctl is needed to switch devices
+        self.current_addr = addr
+        
+    def write(self, cmd, addr=None):
+        # appends the null character and sends the string over I2C
+        cmd += "\00"
+        self.bus.write(self.current_addr if addr is None else addr, cmd.encode('ascii'))
+        
+    def decode(self, res):
+        # splits a raw reply into its status byte and its text, the status is 1 when the
+        # command succeeded, 2 when it failed, 254 while still processing and 255 without data
+        data = bytearray(res).replace(b'\x00', b'')     # remove the null characters to get the response
+        if len(data) == 0:
+            return 255, ''
+        # change MSB to 0 for all received characters except the first
+        # NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
+        return data[0], ''.join([chr(c & ~0x80) for c in data[1:]])
+        
+    def read(self, num_of_bytes=31, addr=None):
+        # reads a specified number of bytes from I2C, then parses and displays the result
+        if addr is None:
+            addr = self.current_addr
+        status, text = self.decode(self.bus.read(addr, num_of_bytes))   # read from the board
+        if status == 1:             # if the response isn't an error
+            if addr == 99: # pH sensor
+                return "pH: " + text
+            elif addr == 100: # EC sensor
+                fields = string.split(text, ",")
+                return "EC: " + fields[0] + "\nTDS: " + fields[1] + "\nSalinity: " + fields[2] + "\nGravity: " + fields[3]
+            elif addr == 102: # RTD sensor
+                return "Soluble Temperature: " + text + " C"
+            else:           # other boards, e.g. DO or ORP, or readdressed ones
+                return text
+        else:
+            return "Error " + str(status)
+        
+    def read_values(self, num_of_bytes=31, addr=None):
+        # reads the reply to a reading command as numbers, without building display strings
+        if addr is None:
+            addr = self.current_addr
+        status, text = self.decode(self.bus.read(addr, num_of_bytes))
+        values = ()
+        if status == 1:
+            try:
+                values = tuple([float(v) for v in text.split(",")])
+            except ValueError:
+                status = 2      # a garbled reply counts as a failed command
+        ATLAS_REPLIES.inc(address=addr, status=status)
+        return AtlasReading(addr, status, values)
+    
+    def query(self, string):
+        # write a command to the board, wait the correct timeout, and read the response
+        with ATLAS_QUERY_SECONDS.time(address=self.current_addr):
+            self.write(string)
+            
+            # the read and calibration commands require a longer timeout
+            if((string.upper().startswith("R")) or
+                (string.upper().startswith("CAL"))):
+                time.sleep(self.long_timeout)
+            elif string.upper().startswith("SLEEP"):
+                return "sleep mode"
+            else:
+                time.sleep(self.short_timeout)
+                
+            return self.read()
+        
+    def query_all(self, addresses, string="R", values=False):
+        # write a command to every board first so they all convert at the same time,
+        # wait a single timeout, then collect the response of each board in turn,
+        # as display strings or as AtlasReading records when values is set
+        time.sleep(self.start_all(addresses, string))
+        return self.collect_all(addresses, values)
+        
+    def start_all(self, addresses, string="R"):
+        # first half of query_all, sends the command to every board and returns the
+        # seconds to wait before collect_all, so a scheduler can do other work meanwhile
+        for addr in addresses:
+            self.write(string, addr)
+            
+        # the read and calibration commands require a longer timeout
+        if((string.upper().startswith("R")) or
+            (string.upper().startswith("CAL"))):
+            return self.long_timeout
+        else:
+            return self.short_timeout
+            
+    def collect_all(self, addresses, values=False):
+        # second half of query_all, reads the response of each board in turn
+        responses = []
+        for addr in addresses:
+            if values:
+                responses.append(self.read_values(addr=addr))
+            else:
+                responses.append(self.read(addr=addr))
+        return responses
+        
+    def close(self):
+        # the bus stays open for the other handles on it
+        self.bus = None
+
+#
+#   BH1750
+#
+
+class BH1750():
+    # define constants
+    default_address = 0x23              # the default address for the sensor
+    default_bus = 1                     # the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
+    POWER_DOWN = 0x00                   # No active state
+    POWER_ON = 0x01                     # Power on
+    RESET = 0x07                        # Reset data register value
+    CONTINUOUS_LOW_RES_MODE = 0x13      # Start measurement at 4lx resolution. Time typically 16ms
+    CONTINUOUS_HIGH_RES_MODE_1 = 0x10   # Start measurement at 1lx resolution. Time typically 120ms
+    CONTINUOUS_HIGH_RES_MODE_2 = 0x11   # Start measurement at 0.5lx resolution. Time typically 120ms
+    ONE_TIME_HIGH_RES_MODE_1 = 0x20     # Start measurement at 1lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
+    ONE_TIME_HIGH_RES_MODE_2 = 0x21     # Start measurement at 0.5lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
+    ONE_TIME_LOW_RES_MODE = 0x23        # Start measurement at 1lx resolution. Time typically 120ms. Device is automatically set to Power Down after measurement.
+    
+    def __init__(self, bus=default_bus):
+        self.bus = I2CBus.get(bus)
+    
+    def convertToNumber(self, data):
+        return ((data[1]+(256*data[0]))/1.2)
+
+    def readLight(self, addr=default_address):
+        # the mode byte and the 2 byte result go out as one combined transaction
+        with BH1750_READ_SECONDS.time(address=addr):
+            data = bytearray(self.bus.write_read(addr, [self.ONE_TIME_HIGH_RES_MODE_1], 2))
+        return self.convertToNumber(data)
+
+    def setMode(self, mode, addr=default_address):
+        # powers the chip on and starts one of the continuous modes, the first result
+        # is ready after measurementTime(mode)
+        self.bus.write(addr, [self.POWER_ON])
+        self.bus.write(addr, [mode])
+
+    def measurementTime(self, mode):
+        # worst case conversion time of a mode in seconds
+        if mode in (self.CONTINUOUS_LOW_RES_MODE, self.ONE_TIME_LOW_RES_MODE):
+            return 0.024
+        return 0.18
+
+    def readContinuous(self, mode, addr=default_address):
+        # reads the last result of a continuous mode, without starting a new measurement
+        with BH1750_READ_SECONDS.time(address=addr):
+            lux = self.convertToNumber(bytearray(self.bus.read(addr, 2)))
+        if mode in (self.CONTINUOUS_HIGH_RES_MODE_2, self.ONE_TIME_HIGH_RES_MODE_2):
+            lux /= 2    # the 0.5lx modes count in half steps
+        return lux
+
+    def powerDown(self, addr=default_address):
+        self.bus.write(addr, [self.POWER_DOWN])
+
+#
+#   Shield metrics
+#
+
+# metrics kept in the local statistic, in column order, with their display unit, the
+# physical range of the sensor and the smallest spread the spike filter assumes (None: no spike filter)
+STAT_METRICS = [('Ambient Temperature', ' C', -40, 80, 0.5),       # DHT22
+                ('Ambient Humidity', ' %', 0, 100, 2.0),            # DHT22
+                ('pH', '', 0, 14, 0.05),
+                ('EC', '', 0, 500000, 10.0),                        # uS/cm
+                ('TDS', '', 0, 500000, 10.0),                       # ppm
+                ('Salinity', '', 0, 42, 0.05),                      # PSU
+                ('Gravity', '', 1.0, 1.3, 0.002),
+                ('RTD', '', -126, 1254, 0.2),                       # C
+                ('Light Intensity', ' lx', 0, 65535, None)]         # lights switch on and off in one step
+
+# columns of the local statistic filled by each type of Atlas board
+ATLAS_COLUMNS = {'pH': [2],
+                 'EC': [3, 4, 5, 6],    # EC, TDS, Salinity, Gravity
+                 'RTD': [7]}
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+import numpy
+import metrics
+from uplink import TelemetryUplink, make_sink
+from sensor_store import SensorStore
+import scheduler
+from scheduler import Scheduler
+from sample_filter import SampleFilter, QUALITY_RANGE, QUALITY_SPIKE
+from dht_sampler import DHTSampler
+from light_sampler import LightSampler
+from i2c_bus import I2CBus, open_channel
+from i2c_discovery import I2CDiscovery, ATLAS_RANGE, KNOWN_RANGE
+from shield_sensors import AtlasI2C, BH1750, STAT_METRICS, ATLAS_COLUMNS
+
+try:
+    from queue import Queue, Empty      # python 3
+except ImportError:
+    from Queue import Queue, Empty
+
+#
+#   Multi-rack supervisor
+#
+#   python supervisor.py racks.json
+#
+#   drives every rack listed in the config from one process, e.g.
+#
+#   {"poll_timer": 10, "atlas_timer": 10, "gcp_timer": 60,
+#    "uplink_target": "http://127.0.0.1:8085/telemetry", "store_path": "racks",
+#    "groups": [{"name": "rack-1", "bus": 1, "dht_pin": 24},
+#               {"name": "rack-2", "bus": 1, "mux": "0x70", "channel": 0, "dht_pin": 25},
+#               {"name": "rack-3", "bus": 1, "mux": "0x70", "channel": 1, "light": null},
+#               {"name": "rack-4", "bus": 3, "atlas": [99, 100]}]}
+#
+#   A group is the sensors of one rack: the Atlas boards on its bus or multiplexer
+#   channel (found by discovery at the addresses of KNOWN_RANGE unless listed under
+#   "atlas"), a BH1750 ("light", the address, null for none) and a DHT22 ("dht_pin").
+#   Each I2C bus gets a worker thread that samples its groups one after the other,
+#   the buses run concurrently. Every sample goes into one stream, tagged with its group.
+#
+
+# one sample of a group, values and quality in the columns of STAT_METRICS
+TaggedSample = namedtuple('TaggedSample', ['group', 'timestamp', 'values', 'quality'])
+
+DEFAULTS = {'poll_timer': 10,           # seconds per sample of every group
+            'atlas_timer': 10,          # seconds per Atlas reading
+            'gcp_timer': 60,            # seconds per uplink batch
+            'dht_max_age': 30,          # seconds a cached DHT22 reading stays valid
+            'light_max_age': 5,         # seconds a cached light reading stays valid
+            'atlas_max_age': 30,        # seconds a cached Atlas reading stays valid
+            'uplink_target': "http://127.0.0.1:8085/telemetry",
+            'store_path': "racks",      # one sensor store and uplink spool per group below it
+            'metrics_port': 9108}       # Prometheus text at http://<pi>:9108/metrics, null for none
+
+IDENTIFY_ATTEMPTS = 3                   # discoveries an address in the Atlas range gets to answer "I"
+RETRY_BACKOFF = (10, 3600)              # seconds between discoveries of an incomplete device map
+
+JOB_ERRORS = metrics.counter('plantos_supervisor_job_errors_total', "Exceptions raised by a job of a bus worker or the main loop", ['bus', 'job'])
+
+def guarded(func, bus=None):
+    # runs func as a job whose exceptions are logged and counted, an exception would
+    # otherwise end its scheduler, stopping the sampling of a bus or the main loop
+    def job():
+        try:
+            func()
+        except Exception:
+            JOB_ERRORS.inc(bus=bus if bus is not None else 'main', job=func.__name__)
+            sys.stderr.write("%s: %s failed\n%s" % ("Bus %s" % bus if bus is not None else "Supervisor",
+                                                   func.__name__, traceback.format_exc()))
+    job.__name__ = func.__name__
+    return job
+
+def address(value):
+    # addresses are written as numbers or as strings like "0x70" in the config
+    if value is None or isinstance(value, int):
+        return value
+    return int(value, 0)
+
+def load_config(path):
+    with open(path) as f:
+        config = dict(DEFAULTS)
+        config.update(json.load(f))
+    names = [group['name'] for group in config['groups']]
+    if len(set(names)) != len(names):
+        raise ValueError("group names must be unique")
+    return config
+
+class DeviceGroup:
+    # The sensors of one rack and the state of their readings. bus is a bus number
+    # or the name of a multiplexer channel from open_channel. Nothing here talks to
+    # the bus outside the calls of the worker of the bus, apart from the LightSampler.
+
+    def __init__(self, name, bus, atlas=None, light=BH1750.default_address, dht_pin=None, exclude=()):
+        self.name = name
+        self.bus = bus
+        self.device = AtlasI2C(bus=bus)
+        self.discovery = I2CDiscovery(bus, atlas if atlas is not None else KNOWN_RANGE)
+        self.exclude = set(exclude)     # upstream devices, seen on every channel of a multiplexer
+        self.light = LightSampler(BH1750(bus), light) if light is not None else None
+        self.dht = DHTSampler(dht_pin) if dht_pin is not None else None
+        self.devices = {}
+        self.addresses = []
+        self.unanswered = {}            # address in the Atlas range: discoveries in a row it stayed unknown
+        self.silent = set()             # addresses in the Atlas range that are not Atlas boards, e.g. an RTC at 0x68
+        self.retry_delay = 0
+        self.retry_time = 0.0
+        self.atlas_sample = numpy.empty(len(STAT_METRICS)) # latest Atlas readings, in the columns of the statistic
+        self.atlas_sample.fill(numpy.nan)
+        self.atlas_time = None
+        self.filter = SampleFilter([m[2] for m in STAT_METRICS], [m[3] for m in STAT_METRICS],
+                                   [m[4] for m in STAT_METRICS])
+        self.samples = 0
+        self.bus_errors = 0
+
+    def start(self):
+        for sampler in (self.light, self.dht):
+            if sampler is not None:
+                sampler.start()
+        self.refresh()
+
+    def stop(self):
+        for sampler in (self.light, self.dht):
+            if sampler is not None:
+                sampler.stop()
+
+    def refresh(self):
+        # a board went away or changed, rebuild the device map
+        try:
+            self.devices = self.discovery.refresh()
+        except (IOError, OSError):
+            self.bus_errors += 1
+            self.devices = {}
+        self.addresses = [addr for addr in sorted(self.devices)
+                          if addr not in self.exclude and self.devices[addr] in ATLAS_COLUMNS]
+        for addr in ATLAS_RANGE:
+            if self.devices.get(addr) != 'unknown':
+                self.unanswered.pop(addr, None)
+                self.silent.discard(addr)
+            elif addr not in self.silent:
+                self.unanswered[addr] = self.unanswered.get(addr, 0) + 1
+                if self.unanswered[addr] >= IDENTIFY_ATTEMPTS:
+                    self.silent.add(addr)
+                    sys.stderr.write("%s: 0x%02x does not answer as an Atlas board, no longer waited for\n"
+                                     % (self.name, addr))
+
+    def incomplete(self):
+        # the last discovery failed, or a board in the Atlas range did not answer "I" yet
+        return not self.devices or [addr for addr in self.devices if self.devices[addr] == 'unknown'
+                                    and addr in ATLAS_RANGE and addr not in self.silent]
+
+    def start_atlas(self):
+        # sends "R" to the boards, returns the seconds to wait before collect_atlas
+        if self.incomplete() and scheduler.monotonic() >= self.retry_time:
+            # each discovery probes the whole bus, they get further apart while it stays incomplete
+            self.refresh()
+            if self.incomplete():
+                self.retry_delay = min(max(self.retry_delay * 2, RETRY_BACKOFF[0]), RETRY_BACKOFF[1])
+            else:
+                self.retry_delay = 0
+            self.retry_time = scheduler.monotonic() + self.retry_delay
+        try:
+            return self.device.start_all(self.addresses)
+        except IOError:
+            self.bus_errors += 1
+            self.refresh()
+            return 0.0
+
+    def collect_atlas(self):
+        try:
+            readings = self.device.collect_all(self.addresses, values=True)
+        except IOError:
+            self.bus_errors += 1
+            self.refresh()
+            return
+        self.atlas_sample.fill(numpy.nan)
+        for reading in readings:
+            columns = ATLAS_COLUMNS[self.devices[reading.address]]
+            if reading.status == 1 and len(reading.values) == len(columns):
+                self.atlas_sample[columns] = reading.values
+        self.atlas_time = time.time()
+
+    def sample(self, config):
+        # one filtered sample of the latest reading of every sensor of the group
+        now = time.time()
+        sample = numpy.empty(len(STAT_METRICS))
+        sample.fill(numpy.nan)
+        if self.dht is not None:
+            humidity, temperature, age = self.dht.latest()
+            if humidity is not None and age <= config['dht_max_age']:
+                sample[0] = temperature
+                sample[1] = humidity
+        if self.atlas_time is not None and now - self.atlas_time <= config['atlas_max_age']:
+            columns = ~numpy.isnan(self.atlas_sample)
+            sample[columns] = self.atlas_sample[columns]
+        if self.light is not None:
+            lux, age = self.light.latest()
+            if lux is not None and age <= config['light_max_age']:
+                sample[8] = lux
+        quality = self.filter.apply(sample).copy()
+        self.samples += 1
+        return TaggedSample(self.name, now, sample, quality)
+
+class BusWorker(threading.Thread):
+    # Samples the groups of one I2C bus on its own thread and scheduler. The Atlas
+    # boards of all groups are started together and convert at the same time, also
+    # behind different multiplexer channels, then collected after the longest wait.
+
+    def __init__(self, bus, groups, stream, config):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.bus = bus
+        self.groups = groups
+        self.stream = stream        # queue the tagged samples of every worker go to
+        self.config = config
+        self.scheduler = Scheduler()
+
+    def start_atlas(self):
+        wait = max([group.start_atlas() for group in self.groups])
+        self.scheduler.after(wait, guarded(self.collect_atlas, self.bus))
+
+    def collect_atlas(self):
+        for group in self.groups:
+            group.collect_atlas()
+
+    def poll(self):
+        for group in self.groups:
+            self.stream.put(group.sample(self.config))
+
+    def run(self):
+        for group in self.groups:
+            group.start()
+        self.scheduler.every(self.config['atlas_timer'], guarded(self.start_atlas, self.bus))
+        self.scheduler.every(self.config['poll_timer'], guarded(self.poll, self.bus),
+                             delay=AtlasI2C.long_timeout + 1) # after the first Atlas readings
+        self.scheduler.run()
+
+    def stop(self):
+        self.scheduler.stop()
+        for group in self.groups:
+            group.stop()
+
+class Supervisor:
+    # Builds the groups and bus workers of a config and merges the samples of all
+    # workers into one stream, read with samples().
+
+    def __init__(self, config):
+        self.config = config
+        self.stream = Queue()
+        self.groups = []
+        self.workers = []
+        buses = {}
+        for entry in config['groups']:
+            buses.setdefault(entry['bus'], []).append(entry)
+        for bus in sorted(buses):
+            entries = buses[bus]
+            muxes = sorted(set([address(entry['mux']) for entry in entries if entry.get('mux') is not None]))
+            upstream = []
+            if muxes:
+                # switch every channel off, then the devices that still answer are upstream
+                # and show up on every channel too; retried, a glitch here would stop the supervisor
+                for attempt in range(3):
+                    try:
+                        for mux in muxes:
+                            I2CBus.get(bus).write(mux, [0])
+                        upstream = I2CDiscovery(open_channel(bus, muxes[0], None), KNOWN_RANGE).probe()
+                        break
+                    except (IOError, OSError):
+                        if attempt == 2:
+                            raise
+                        time.sleep(0.1)
+            groups = []
+            for entry in entries:
+                mux = address(entry.get('mux'))
+                if mux is not None:
+                    name = open_channel(bus, mux, entry['channel'])
+                    exclude = upstream
+                elif muxes:
+                    name = open_channel(bus, muxes[0], None)   # keep the channels off while it is sampled
+                    exclude = ()
+                else:
+                    name = bus
+                    exclude = ()
+                atlas = entry.get('atlas')
+                groups.append(DeviceGroup(entry['name'], name,
+                                          [address(a) for a in atlas] if atlas is not None else None,
+                                          address(entry.get('light', BH1750.default_address)),
+                                          entry.get('dht_pin'), exclude))
+            self.groups.extend(groups)
+            self.workers.append(BusWorker(bus, groups, self.stream, config))
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def samples(self, timeout=1.0):
+        # the tagged samples waiting in the stream, in the order they were taken
+        samples = []
+        try:
+            samples.append(self.stream.get(True, timeout))
+            while True:
+                samples.append(self.stream.get_nowait())
+        except Empty:
+            pass
+        return samples
+
+#
+#   Main
+#
+
+def main(config_path=None):
+    config = load_config(config_path or (sys.argv[1] if len(sys.argv) > 1 else "racks.json"))
+    fields = [m[0] for m in STAT_METRICS]
+    supervisor = Supervisor(config)
+    sink = make_sink(config['uplink_target'])
+    stores = {}
+    uplinks = {}
+    for group in supervisor.groups:
+        path = os.path.join(config['store_path'], group.name)
+        stores[group.name] = SensorStore(path, fields)
+        # one device id per rack, so the receiver keeps their series apart
+        uplinks[group.name] = TelemetryUplink(sink, fields, path + ".spool",
+                                              socket.gethostname() + "/" + group.name)
+    main_scheduler = Scheduler()   # jobs of the main thread, the workers have their own
+
+    # Stream Task, the merged samples of every rack go to their store and uplink
+    def drain():
+        for tagged in supervisor.samples(0):
+            stores[tagged.group].append(tagged.timestamp, tagged.values, tagged.quality)
+            uplinks[tagged.group].add(tagged.timestamp, tagged.values)
+            readings = ["%s=%g" % (fields[i], tagged.values[i]) for i in numpy.flatnonzero(~numpy.isnan(tagged.values))]
+            rejected = numpy.count_nonzero(tagged.quality & (QUALITY_RANGE | QUALITY_SPIKE))
+            print("%s %s %s%s" % (time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(tagged.timestamp)),
+                                  tagged.group, ", ".join(readings),
+                                  " (%d rejected)" % rejected if rejected else ""))
+
+    # GCP Pub/Sub Task, one compressed batch per rack and window
+    def upload():
+        for name in sorted(uplinks):
+            uplinks[name].flush()
+
+    if config['metrics_port'] is not None:
+        metrics.serve(config['metrics_port'])
+    metrics.gauge('plantos_supervisor_queue_depth', "Tagged samples waiting in the stream").set_function(supervisor.stream.qsize)
+    samples = metrics.gauge('plantos_group_samples', "Samples taken of a rack", ['group'])
+    bus_errors = metrics.gauge('plantos_group_bus_errors', "Failed Atlas cycles and discoveries of a rack", ['group'])
+    for group in supervisor.groups:
+        samples.set_function(lambda group=group: group.samples, group=group.name)
+        bus_errors.set_function(lambda group=group: group.bus_errors, group=group.name)
+    supervisor.start()
+    main_scheduler.every(1, guarded(drain))
+    main_scheduler.every(config['gcp_timer'], guarded(upload), delay=config['gcp_timer'])
+    try:
+        main_scheduler.run()
+    except KeyboardInterrupt:       # catches the ctrl-c command, which stops every worker
+        supervisor.stop()
+        drain()
+        for store in stores.values():
+            store.flush()
+        for worker in supervisor.workers:
+            for job in worker.scheduler.jobs():
+                print("bus %s %s: %d runs, %d missed, %.3f s max late, %.3f s max duration" % (
+                    worker.bus, job.name, job.runs, job.missed, job.max_late, job.max_duration))
+        for group in supervisor.groups:
+            print("%s: %d samples, %d Atlas boards, %d bus errors" % (
+                group.name, group.samples, len(group.addresses), group.bus_errors))
+        print("Supervisor stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+import os
+import random
+import socket
+import struct
+import sys
+import time
+import zlib
+import numpy
+try:
+    from urllib.request import Request, urlopen     # python 3
+except ImportError:
+    from urllib2 import Request, urlopen            # python 2
+
+#
+#   Batch encoding
+#
+#   A batch carries every reading of one upload window:
+#       magic 'PTB1', device id, field names, row count,
+#       float64 timestamps[rows], float32 values[rows][fields]
+#   and is zlib compressed as a whole.
+#
+
+BATCH_MAGIC = b'PTB1'
+SPOOL_HEADER = struct.Struct('>II')     # batch length and CRC-32 of a spool record
+
+def encode_batch(device_id, fields, timestamps, values):
+    device_id = device_id.encode('utf-8')
+    names = ','.join(fields).encode('utf-8')
+    header = BATCH_MAGIC + struct.pack('>H', len(device_id)) + device_id
+    header += struct.pack('>H', len(names)) + names + struct.pack('>I', len(timestamps))
+    body = numpy.asarray(timestamps, dtype='>f8').tobytes() + numpy.asarray(values, dtype='>f4').tobytes()
+    return zlib.compress(header + body, 9)
+
+def decode_batch(payload):
+    # returns (device id, field names, timestamps, values) of an encoded batch
+    data = zlib.decompress(payload)
+    if data[:4] != BATCH_MAGIC:
+        raise ValueError("not a telemetry batch")
+    pos = 4
+    n = struct.unpack('>H', data[pos:pos + 2])[0]
+    device_id = data[pos + 2:pos + 2 + n].decode('utf-8')
+    pos += 2 + n
+    n = struct.unpack('>H', data[pos:pos + 2])[0]
+    fields = data[pos + 2:pos + 2 + n].decode('utf-8').split(',')
+    pos += 2 + n
+    rows = struct.unpack('>I', data[pos:pos + 4])[0]
+    pos += 4
+    timestamps = numpy.frombuffer(data, dtype='>f8', count=rows, offset=pos)
+    pos += 8 * rows
+    values = numpy.frombuffer(data, dtype='>f4', count=rows * len(fields), offset=pos)
+    return device_id, fields, timestamps, values.reshape(rows, len(fields))
+
+#
+#   Sinks
+#
+
+class HttpSink:
+    # POSTs each batch to an HTTP endpoint, e.g. the stand-in receiver of this module
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, payload):
+        request = Request(self.url, payload, {'Content-Type': 'application/x-plantos-batch'})
+        urlopen(request, timeout=self.timeout).read()
+
+class PubSubSink:
+    # publishes each batch as one Google Cloud Pub/Sub message
+    def __init__(self, project, topic, timeout=30):
+        from google.cloud import pubsub_v1     # only needed on units uploading to GCP
+        self.publisher = pubsub_v1.PublisherClient()
+        self.topic = self.publisher.topic_path(project, topic)
+        self.timeout = timeout
+
+    def send(self, payload):
+        self.publisher.publish(self.topic, payload).result(timeout=self.timeout)
+
+def make_sink(target):
+    # "pubsub://<project>/<topic>" or an http(s) URL
+    if target.startswith("pubsub://"):
+        project, topic = target[len("pubsub://"):].split("/", 1)
+        return PubSubSink(project, topic)
+    return HttpSink(target)
+
+#
+#   Uplink
+#
+
+class TelemetryUplink:
+    # Buffers readings and uploads them as one compressed batch per flush().
+    # Batches that cannot be sent are appended to a local spool file and replayed,
+    # oldest first, with exponential backoff once the sink is reachable again.
+    # The spool is only ever appended to; the offset of the first unsent batch is
+    # kept in a small side file and the spool is emptied once everything is sent.
+    # Each spooled batch is preceded by its length and CRC-32, a record cut short
+    # by a power loss is truncated away with everything after it. Once the unsent
+    # batches would take more than max_spool bytes the oldest ones are dropped.
+
+    def __init__(self, sink, fields, spool_path, device_id=None, min_backoff=5, max_backoff=600,
+                 max_spool=16 * 1024 * 1024):
+        self.sink = sink
+        self.fields = list(fields)
+        self.spool_path = spool_path
+        self.offset_path = spool_path + ".offset"
+        self.device_id = device_id or socket.gethostname()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_spool = max_spool      # bytes, ~60000 one minute batches
+        self.backoff = 0
+        self.retry_time = 0
+        self.timestamps = []
+        self.rows = []
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0                # spooled batches dropped to keep the spool under max_spool
+        self.repair_spool()
+
+    def add(self, timestamp, row):
+        self.timestamps.append(timestamp)
+        self.rows.append(numpy.array(row, dtype=numpy.float32))
+
+    def flush(self):
+        # packs the buffered readings into one batch and sends it, or spools it
+        if self.rows:
+            payload = encode_batch(self.device_id, self.fields, self.timestamps, self.rows)
+            self.timestamps = []
+            self.rows = []
+        else:
+            payload = None
+        # spooled batches go first so the receiver sees them in order
+        if self.pending() and not self.replay():
+            if payload is not None:
+                self.spool(payload)
+            return False
+        if payload is not None:
+            if not self.send(payload):
+                self.spool(payload)
+                return False
+        return True
+
+    def send(self, payload):
+        if time.time() < self.retry_time:
+            return False
+        try:
+            self.sink.send(payload)
+        except Exception as e:
+            self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+            self.retry_time = time.time() + self.backoff * random.uniform(0.5, 1.0)
+            sys.stderr.write("Uplink failed (%s), retrying in %d s\n" % (e, self.backoff))
+            return False
+        self.backoff = 0
+        self.retry_time = 0
+        self.sent += 1
+        return True
+
+    def spool(self, payload):
+        record_size = SPOOL_HEADER.size + len(payload)
+        if os.path.exists(self.spool_path) and os.path.getsize(self.spool_path) + record_size > self.max_spool:
+            self.compact_spool(self.max_spool * 3 // 4 - record_size)
+        with open(self.spool_path, "ab") as f:
+            end = f.tell()
+            try:
+                f.write(SPOOL_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            except (IOError, OSError) as e:
+                # e.g. a full SD card, a partial record would hide the batches after it
+                f.truncate(end)
+                sys.stderr.write("Spooling failed (%s), batch dropped\n" % e)
+                return
+        self.spooled += 1
+
+    def read_record(self, f):
+        # the next spooled batch, None at the end of the spool or at a damaged record
+        header = f.read(SPOOL_HEADER.size)
+        if len(header) < SPOOL_HEADER.size:
+            return None
+        size, crc = SPOOL_HEADER.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size or zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return payload
+
+    def truncate_spool(self, f, end):
+        size = os.fstat(f.fileno()).st_size
+        if end < size:
+            sys.stderr.write("Dropping %d bytes of damaged spool records\n" % (size - end))
+            f.truncate(end)
+
+    def repair_spool(self):
+        # truncates the spool after its last whole record
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, "r+b") as f:
+            f.seek(self.read_offset())
+            end = f.tell()
+            while self.read_record(f) is not None:
+                end = f.tell()
+            self.truncate_spool(f, end)
+
+    def compact_spool(self, limit):
+        # rewrites the spool with the newest unsent batches that fit in limit bytes
+        with open(self.spool_path, "rb") as f:
+            f.seek(self.read_offset())
+            records = []
+            while True:
+                payload = self.read_record(f)
+                if payload is None:
+                    break
+                records.append(payload)
+        kept = []
+        size = 0
+        for payload in reversed(records):
+            size += SPOOL_HEADER.size + len(payload)
+            if size > limit:
+                break
+            kept.append(payload)
+        kept.reverse()
+        tmp = self.spool_path + ".tmp"
+        with open(tmp, "wb") as f:
+            for payload in kept:
+                f.write(SPOOL_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        # the old offset does not apply to the new file; a crash between these two
+        # steps replays the old spool from its start, sending some batches twice
+        self.remove_offset()
+        os.rename(tmp, self.spool_path)
+        self.dropped += len(records) - len(kept)
+        sys.stderr.write("Spool over %d bytes, dropped the %d oldest batches\n" % (self.max_spool, len(records) - len(kept)))
+
+    def pending(self):
+        return os.path.exists(self.spool_path) and os.path.getsize(self.spool_path) > self.read_offset()
+
+    def read_offset(self):
+        # an offset without its spool, or past its end, is left from a crash
+        try:
+            size = os.path.getsize(self.spool_path)
+            with open(self.offset_path) as f:
+                offset = int(f.read() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+        return offset if offset <= size else 0
+
+    def write_offset(self, offset):
+        # replaced by rename, a crash leaves the previous offset or the new one
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.offset_path)
+
+    def remove_offset(self):
+        if os.path.exists(self.offset_path):
+            os.remove(self.offset_path)
+
+    def replay(self):
+        # sends spooled batches in order, returns True once the spool is empty
+        start = offset = self.read_offset()
+        with open(self.spool_path, "r+b") as f:
+            f.seek(offset)
+            while True:
+                payload = self.read_record(f)
+                if payload is None:
+                    self.truncate_spool(f, offset)
+                    break
+                if not self.send(payload):
+                    if offset != start:
+                        self.write_offset(offset)
+                    return False
+                offset = f.tell()
+        # the offset goes first, a stale one would hide the batches spooled next
+        self.remove_offset()
+        os.remove(self.spool_path)
+        return True
+
+#
+#   Stand-in receiver
+#
+#   python uplink.py [port]
+#   accepts batches over HTTP and prints what they carry, for testing without GCP
+#
+
+def serve(port=8085):
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Receiver(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = self.rfile.read(int(self.headers['Content-Length']))
+            device_id, fields, timestamps, values = decode_batch(payload)
+            print("%s: %d readings (%d bytes) from %s, %s to %s" % (
+                self.path, len(timestamps), len(payload), device_id,
+                time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(timestamps[0])),
+                time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(timestamps[-1]))))
+            for i in range(len(fields)):
+                print("    %s: %s" % (fields[i], numpy.nanmean(values[:, i])))
+            self.send_response(204)
+            self.end_headers()
+
+    HTTPServer(('', port), Receiver).serve_forever()
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8085)
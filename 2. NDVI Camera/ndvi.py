@@ -6,118 +6,303 @@ Credits to Maik for original code: maik@maikbasso.com.br
 import time
 import numpy as np
 import os
+import sys
 import cv2
-import cv
-import picamera
-import picamera.array
+from ndvi_pipeline import NdviPipeline, CameraSource
+from ndvi_roi import RegionStats, gridLabels
+from ndvi_adaptive import AdaptiveNdvi, ThrottledSource
+from ndvi_export import NdviExporter, MjpegPreview
+#the metrics registry is shared with the shield scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1. Computer', 'PlantOS Shield v2'))
+import metrics
+
+calculateSeconds = metrics.histogram('plantos_ndvi_calculate_seconds', "calculateNdvi calls")
+computeSeconds = metrics.histogram('plantos_ndvi_compute_seconds', "Compute stage per frame, regions included", ['mode'])
+frameLatency = metrics.histogram('plantos_ndvi_frame_latency_seconds', "Capture to display of a frame")
+fps = metrics.gauge('plantos_ndvi_fps', "Frames shown per second")
+
+#camera resolutions, run() captures at the 320x240 entry
+resolution = [[1920,1080],[1336,768],[1280,720],[1024,768],[800,600],[640,480],[320,240],[160,120],[100,133]]
+
+class NdviEngine:
+	"""
+	Computes the NDVI of frames in float32 buffers that are allocated once per resolution
+	"""
+	def __init__(self):
+		self.shape = None
+		self.ndvi = None
+		self.bottom = None
+
+	def allocate(self, shape):
+		self.shape = shape
+		self.ndvi = np.empty(shape, dtype=np.float32)
+		self.bottom = np.empty(shape, dtype=np.float32)
+
+	def calculate(self, nir, b):
+		"""
+		Returns the NDVI of the frame and its average, the NDVI array is overwritten by the next call
+		"""
+		if nir.shape != self.shape:
+			self.allocate(nir.shape)
+		np.subtract(nir, b, out=self.ndvi, dtype=np.float32)
+		np.add(nir, b, out=self.bottom, dtype=np.float32)
+		# the bands are unsigned so the sum is only zero where both are zero, the
+		# difference is then zero too and dividing by one gives the expected 0
+		np.maximum(self.bottom, 1, out=self.bottom)
+		np.divide(self.ndvi, self.bottom, out=self.ndvi)
+		average = float(self.ndvi.sum(dtype=np.float64)) / self.ndvi.size
+		return self.ndvi, average
 
 def calculateNdvi(nir, g, b):
 	"""
-	Performs the calculation of the NDVI of an image
+	Performs the calculation of the NDVI of an image into a new array, so results stay
+	valid and callers can run in parallel. Loops that want the buffers reused keep
+	their own NdviEngine
 	"""
-	top = (nir.astype(float) - b.astype(float))
-	bottom = (nir.astype(float) + b.astype(float))
-	# avoid division by zero in the entire array
-	bottom[bottom == 0] = 0.00001
-	ndvi = top / bottom
+	with calculateSeconds.time():
+		ndvi, average = NdviEngine().calculate(nir, b)
 	return ndvi
 
-def displayImage(img, r, g, b, ndvi):
+class ContrastStretch:
 	"""
-	Displays the results
-	"""	
-	#contrast adjustment
-	in_min = np.percentile(ndvi, 5)
-	in_max = np.percentile(ndvi, 95)
-	out_min = 0.0
-	out_max = 255.0
-	out = ndvi - in_min
-	out *= ((out_min - out_max) / (in_min - in_max))
-	out += in_min
-	ndviGray = out
-	#converts images to acceptable format opencv
-	ndviGray = ndviGray.astype(np.uint8)
+	Stretches NDVI between two percentiles onto 0..255. The percentiles come from a fine
+	histogram of the frame instead of a sort of the whole array, and can be smoothed over
+	recent frames. Only the range between them is quantized, so plant NDVI, often within
+	0.05..0.25, still gets all 256 gray levels.
+	"""
+	bins = 2048    #histogram bins over -1..1, about 0.001 NDVI each
+
+	def __init__(self, low=5, high=95, smoothing=0.0):
+		self.low = low
+		self.high = high
+		self.smoothing = smoothing    # weight of the previous limits, 0 follows each frame exactly
+		self.limits = None
+		self.shape = None
+		self.gray = None
+
+	def allocate(self, shape):
+		self.shape = shape
+		self.gray = np.empty(shape, dtype=np.uint8)
+
+	def percentiles(self, ndvi):
+		"""
+		Returns the low and high percentiles of the NDVI, to the width of a bin
+		"""
+		#the upper bound is exclusive, a little headroom keeps NDVI 1 in the last bin
+		hist = cv2.calcHist([ndvi], [0], None, [self.bins], [-1, 1.0001]).ravel()
+		cdf = np.cumsum(hist)
+		width = 2.0001 / self.bins
+		low = np.searchsorted(cdf, cdf[-1] * self.low / 100.0)
+		high = np.searchsorted(cdf, cdf[-1] * self.high / 100.0)
+		return -1 + low * width, -1 + (high + 1) * width
+
+	def apply(self, ndvi):
+		"""
+		Returns the stretched 8-bit image, the array is overwritten by the next call
+		"""
+		if ndvi.shape != self.shape:
+			self.allocate(ndvi.shape)
+		low, high = self.percentiles(ndvi)
+		if self.limits is not None and self.smoothing > 0:
+			low = self.smoothing * self.limits[0] + (1 - self.smoothing) * low
+			high = self.smoothing * self.limits[1] + (1 - self.smoothing) * high
+		self.limits = (low, high)
+		#(ndvi - low) * scale in one pass, saturated to 0..255
+		scale = 255.0 / max(high - low, 1e-3)
+		cv2.addWeighted(ndvi, scale, ndvi, 0, -low * scale, self.gray, cv2.CV_8U)
+		return self.gray
+
+stretch = ContrastStretch()
+
+def composeImages(img, r, g, b, ndvi):
+	"""
+	Builds the images shown by displayImage, the 2x2 band mosaic and the colour mapped frame
+	"""
+	#contrast adjustment, converts the NDVI to a format acceptable to opencv
+	ndviGray = stretch.apply(ndvi)
 	#identifying the images
 	cv2.putText(r, 'Infrared', (0, 20), cv2.FONT_HERSHEY_SIMPLEX, .8, 255)
 	cv2.putText(g, 'Green', (0, 20), cv2.FONT_HERSHEY_SIMPLEX, .8, 255)
 	cv2.putText(b, 'Blue', (0, 20), cv2.FONT_HERSHEY_SIMPLEX, .8, 255)
 	cv2.putText(ndviGray, 'NDVI-Blue', (0, 20), cv2.FONT_HERSHEY_SIMPLEX, .8, 255)
-	#Combines the images into one to display new:cv.CV_GRAY2RGB old:cv2.COLOR_GRAY2RGB
+	#Combines the images into one to display
 	height, width = r.shape
 	image = np.zeros((2 * height, 2 * width, 3), dtype=np.uint8)
-	image[0:height, 0:width, :] = cv2.cvtColor(r, cv.CV_GRAY2BGR)
-	image[height:, 0:width, :] = cv2.cvtColor(g, cv.CV_GRAY2BGR)
-	image[0:height, width:, :] = cv2.cvtColor(b, cv.CV_GRAY2BGR)
-	image[height:, width:, :] = cv2.cvtColor(ndviGray, cv.CV_GRAY2BGR)
-	# Display
+	image[0:height, 0:width, :] = cv2.cvtColor(r, cv2.COLOR_GRAY2BGR)
+	image[height:, 0:width, :] = cv2.cvtColor(g, cv2.COLOR_GRAY2BGR)
+	image[0:height, width:, :] = cv2.cvtColor(b, cv2.COLOR_GRAY2BGR)
+	image[height:, width:, :] = cv2.cvtColor(ndviGray, cv2.COLOR_GRAY2BGR)
 	im_color = cv2.applyColorMap(img, cv2.COLORMAP_JET)
+	return image, im_color
+
+def displayImage(img, r, g, b, ndvi):
+	"""
+	Displays the results
+	"""	
+	image, im_color = composeImages(img, r, g, b, ndvi)
+	# Display
 	cv2.imshow('Original Image', img)
 	cv2.imshow('NDVI', image)
 	cv2.imshow('NDVI Color', im_color)
 
-def run():
-    with picamera.PiCamera() as camera:
-        #camera settings
-        resolution = [[1920,1080],[1336,768],[1280,720],[1024,768],[800,600],[640,480],[320,240],[160,120],[100,133]]
-        camera.resolution = resolution[6]
-        camera.framerate = 10
-
-        #time to wait for the settings to be applied successfully
-        time.sleep(2)
-        
-        with picamera.array.PiRGBArray(camera) as stream:
-            while True:
-				
-				startTime = time.time()
-				
-				#It's important to configure the bands as "bgr" for use in opencv
-				camera.capture(stream, format='bgr', use_video_port=True)
-				#get the array of the image
-				img = stream.array
-
-				#get color bands
-				b, g, r = cv2.split(img)
-
-				#calculate the NDVI
-				ndvi = calculateNdvi(r, g, b)
-
-				#calculates the average of ndvi region
-				cumulativeNdvi = np.sum(ndvi)
-				totalOfIndexes = img.shape[1]*img.shape[0]
-				averageNdvi = cumulativeNdvi / totalOfIndexes
-				
-				totalTime = time.time() - startTime
-				
-				os.system("clear")
-				print "#" * 41
-				print "#" * 7, "Plant OS NDVI Viewer", "#" * 7
-				print "#" * 41
-				print "\n"
-				print "\tFrame size: %d x %d" %(img.shape[1],img.shape[0])
-				print "\tPixels per frame: %d" %(totalOfIndexes)
-				print "\tCumulative NDVI: %d" %(cumulativeNdvi)
-				print "\tAverage NDVI: %f" %(averageNdvi)
-				print "\n"
-				print "#" * 41
-				print "\tTime per frame: %f s" %(totalTime)
-				print "\tFPS: %f" %(1 / totalTime)
-				print "#" * 41
-
-				#show images
-				displayImage(img, r, g, b, ndvi)
-				
-				#Delete the contents of a stream.
-				stream.truncate(0)
-
-				# If we press ESC then break out of the loop
-				key = cv2.waitKey(7) % 0x100
-				if key == 27:
-					break
-
-    #Clears the cash at the end of the application
-    cv2.destroyAllWindows()
+#rows and columns of tray cells to report on, None reports the whole frame only
+roiGrid = None
+#AdaptiveNdvi deciding between binned and full resolution frames, None computes every frame in full
+adaptiveNdvi = None
+
+def computeFrame(frame):
+	"""
+	Compute stage of the pipeline, every frame slot keeps its own NDVI and region buffers
+	"""
+	started = time.time()
+	if adaptiveNdvi is not None:
+		ndvi, average, full = adaptiveNdvi.calculate(frame)
+		bands = frame.img if full else frame.context['binned']
+	else:
+		frameEngine = frame.context.get('engine')
+		if frameEngine is None:
+			frameEngine = frame.context['engine'] = NdviEngine()
+		#the frame is "bgr", red carries the infrared band
+		ndvi, average = frameEngine.calculate(frame.img[:, :, 2], frame.img[:, :, 0])
+		bands = frame.img
+	regions = None
+	if roiGrid is not None:
+		#the adaptive mode alternates between two sizes, each gets its own labels
+		regionStats = frame.context.get(('regions', ndvi.shape))
+		if regionStats is None:
+			regionStats = frame.context[('regions', ndvi.shape)] = RegionStats(gridLabels(ndvi.shape, *roiGrid))
+		regions = regionStats.compute(ndvi, bands[:, :, 1])
+	frame.result = (ndvi, average, regions)
+	computeSeconds.observe(time.time() - started, mode='full' if bands is frame.img else 'binned')
+
+class Viewer:
+	"""
+	Sink stage of the pipeline, prints the frame statistics and optionally shows the images
+	"""
+	def __init__(self, display=True, exporter=None):
+		self.display = display
+		self.exporter = exporter    #NdviExporter saving or streaming the frames, None for neither
+		self.lastTime = time.time()
+
+	def __call__(self, frame):
+		img = frame.img
+		ndvi, averageNdvi, regions = frame.result
+		totalOfIndexes = img.shape[1]*img.shape[0]
+		cumulativeNdvi = averageNdvi * totalOfIndexes
+		now = time.time()
+		frameTime = now - self.lastTime
+		self.lastTime = now
+		frameLatency.observe(now - frame.captured)
+		fps.set(1 / frameTime)
+
+		#escape codes clear the terminal without spawning "clear" every frame
+		sys.stdout.write("\033[2J\033[H")
+		print "#" * 41
+		print "#" * 7, "Plant OS NDVI Viewer", "#" * 7
+		print "#" * 41
+		print "\n"
+		print "\tFrame size: %d x %d" %(img.shape[1],img.shape[0])
+		print "\tPixels per frame: %d" %(totalOfIndexes)
+		print "\tCumulative NDVI: %d" %(cumulativeNdvi)
+		print "\tAverage NDVI: %f" %(averageNdvi)
+		if ndvi.shape != img.shape[:2]:
+			print "\tNDVI size: %d x %d (binned)" %(ndvi.shape[1],ndvi.shape[0])
+		if regions is not None:
+			for i in range(1, len(regions['pixels'])):
+				print "\tCell %d: NDVI %.3f, plant NDVI %.3f, plant cover %.0f%%" %(i, regions['mean'][i], regions['plantMean'][i], 100 * regions['coverage'][i])
+		print "\n"
+		print "#" * 41
+		print "\tTime per frame: %f s" %(frame.computed - frame.captured)
+		print "\tFPS: %f" %(1 / frameTime)
+		print "#" * 41
+
+		if self.exporter is not None:
+			self.exporter.submit(ndvi, {'timestamp': frame.captured, 'width': img.shape[1], 'height': img.shape[0],
+				'mean': averageNdvi, 'index': frame.index})
+
+		if self.display:
+			#get color bands and show images
+			b, g, r = cv2.split(img)
+			if ndvi.shape != img.shape[:2]:
+				ndvi = cv2.resize(ndvi, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
+			displayImage(img, r, g, b, ndvi)
+			# If we press ESC then stop the pipeline, F asks the adaptive mode for full resolution
+			key = cv2.waitKey(7) % 0x100
+			if key == 27:
+				return False
+			if key in (ord('f'), ord('F')) and adaptiveNdvi is not None:
+				adaptiveNdvi.requestFull()
+		return True
+
+def run(display=True, workers=4, grid=None, adaptive=False, metricsPort=None, exportDir=None,
+		encoding='uint8', exportEvery=1, previewPort=None):
+	global roiGrid, adaptiveNdvi
+	roiGrid = grid
+	adaptiveNdvi = AdaptiveNdvi(NdviEngine) if adaptive else None
+	if metricsPort is not None:
+		metrics.serve(metricsPort)
+	exporter = None
+	if exportDir is not None or previewPort is not None:
+		preview = MjpegPreview(previewPort).start() if previewPort is not None else None
+		exporter = NdviExporter(exportDir, encoding, exportEvery, preview)
+	#imported here so the NDVI functions can be used on machines without a camera
+	import picamera
+	with picamera.PiCamera() as camera:
+		#camera settings
+		camera.resolution = resolution[6]
+		camera.framerate = 10
+
+		#time to wait for the settings to be applied successfully
+		time.sleep(2)
+
+		#capture, NDVI and display run as separate stages, the NDVI stage on all cores
+		source = CameraSource(camera)
+		if adaptiveNdvi is not None:
+			#binned frames at a low rate until something changes
+			source = ThrottledSource(source, adaptiveNdvi)
+		pipeline = NdviPipeline(source, computeFrame, Viewer(display, exporter), workers=workers)
+		#queue depths and frame counts, read when the metrics are rendered
+		depth = metrics.gauge('plantos_ndvi_queue_depth', "Frames waiting for a pipeline stage", ['queue'])
+		depth.set_function(pipeline.to_compute.qsize, queue='compute')
+		depth.set_function(pipeline.to_sink.qsize, queue='sink')
+		frames = metrics.gauge('plantos_ndvi_frames', "Frames through the pipeline since start", ['state'])
+		for state in ('captured', 'dropped', 'delivered'):
+			frames.set_function(lambda state=state: getattr(pipeline, state), state=state)
+		try:
+			pipeline.run()
+		except KeyboardInterrupt:
+			pass
+
+	#Clears the cash at the end of the application
+	if display:
+		cv2.destroyAllWindows()
+	if exporter is not None:
+		exporter.close()
+		if exporter.preview is not None:
+			exporter.preview.stop()
 
 #starts the application here
 if __name__ == "__main__":
 	os.system("clear")
-	run()
+	#--grid RxC reports on a grid of R rows and C columns of tray cells
+	grid = None
+	if "--grid" in sys.argv:
+		grid = tuple(int(n) for n in sys.argv[sys.argv.index("--grid") + 1].lower().split("x"))
+	#--metrics PORT serves the frame timings as Prometheus text on http://<pi>:PORT/metrics
+	metricsPort = None
+	if "--metrics" in sys.argv:
+		metricsPort = int(sys.argv[sys.argv.index("--metrics") + 1])
+	#--export DIR saves every --export-every Nth NDVI frame as a compressed product, uint8 unless --float16
+	exportDir = None
+	if "--export" in sys.argv:
+		exportDir = sys.argv[sys.argv.index("--export") + 1]
+	exportEvery = 1
+	if "--export-every" in sys.argv:
+		exportEvery = int(sys.argv[sys.argv.index("--export-every") + 1])
+	#--preview PORT streams a small MJPEG of the NDVI on http://<pi>:PORT/
+	previewPort = None
+	if "--preview" in sys.argv:
+		previewPort = int(sys.argv[sys.argv.index("--preview") + 1])
+	run(display="--headless" not in sys.argv, grid=grid, adaptive="--adaptive" in sys.argv, metricsPort=metricsPort,
+		exportDir=exportDir, encoding="float16" if "--float16" in sys.argv else "uint8", exportEvery=exportEvery,
+		previewPort=previewPort)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive NDVI: binned frames at a low rate while the scene is steady, full resolution
+at the camera rate when it changes, crosses an NDVI alert level or is asked for
+"""
+import threading
+import time
+import numpy as np
+import cv2
+
+class AdaptiveNdvi:
+	"""
+	Every frame is first binned by factor and its NDVI computed at that size. The frame
+	is escalated to full resolution when the mean absolute NDVI change against the
+	previous binned frame reaches changeThreshold, when the average NDVI leaves
+	alertLow..alertHigh, or after requestFull(). Escalation lasts for hold frames and
+	runs the camera at activeFps, the steady state captures at idleFps.
+	"""
+	def __init__(self, engineType, factor=4, changeThreshold=0.05, alertLow=None, alertHigh=None,
+			hold=20, idleFps=2.0, activeFps=10.0):
+		self.engineType = engineType    # NDVI engine class, one instance per frame slot and size
+		self.factor = factor
+		self.changeThreshold = changeThreshold
+		self.alertLow = alertLow
+		self.alertHigh = alertHigh
+		self.hold = hold
+		self.idleFps = idleFps
+		self.activeFps = activeFps
+		self.lock = threading.Lock()
+		self.previous = None
+		self.remaining = 0          # frames left at full resolution
+		self.full = 0
+		self.fast = 0
+
+	def requestFull(self, frames=None):
+		with self.lock:
+			self.remaining = max(self.remaining, frames or self.hold)
+
+	def interval(self):
+		"""
+		Seconds between captures for the current state
+		"""
+		return 1.0 / (self.activeFps if self.remaining > 0 else self.idleFps)
+
+	def escalate(self, small, average):
+		with self.lock:
+			change = 0.0
+			if self.previous is not None and self.previous.shape == small.shape:
+				change = float(np.abs(small - self.previous).mean())
+			if self.previous is None or self.previous.shape != small.shape:
+				self.previous = small.copy()
+			else:
+				np.copyto(self.previous, small)
+			alert = ((self.alertLow is not None and average < self.alertLow) or
+				(self.alertHigh is not None and average > self.alertHigh))
+			if change >= self.changeThreshold or alert:
+				self.remaining = self.hold
+			if self.remaining > 0:
+				self.remaining -= 1
+				self.full += 1
+				return True
+			self.fast += 1
+			return False
+
+	def engine(self, frame, key):
+		engine = frame.context.get(key)
+		if engine is None:
+			engine = frame.context[key] = self.engineType()
+		return engine
+
+	def calculate(self, frame):
+		"""
+		Returns (ndvi, average, full) of a "bgr" frame, ndvi is the binned NDVI unless full
+		"""
+		img = frame.img
+		height, width = img.shape[:2]
+		size = (max(width // self.factor, 1), max(height // self.factor, 1))
+		binned = frame.context.get('binned')
+		if binned is None or binned.shape[:2] != (size[1], size[0]):
+			binned = frame.context['binned'] = np.empty((size[1], size[0], 3), dtype=np.uint8)
+		#area interpolation averages each factor x factor block, i.e. bins the pixels
+		cv2.resize(img, size, binned, interpolation=cv2.INTER_AREA)
+		small, average = self.engine(frame, 'binnedEngine').calculate(binned[:, :, 2], binned[:, :, 0])
+		if not self.escalate(small, average):
+			return small, average, False
+		ndvi, average = self.engine(frame, 'engine').calculate(img[:, :, 2], img[:, :, 0])
+		return ndvi, average, True
+
+class ThrottledSource:
+	"""
+	Wraps a pipeline source and spaces its captures by the interval of the adaptive state
+	"""
+	def __init__(self, source, adaptive):
+		self.source = source
+		self.adaptive = adaptive
+		self.last = 0.0
+
+	def __call__(self, frame):
+		wait = self.adaptive.interval() - (time.time() - self.last)
+		if wait > 0:
+			time.sleep(wait)
+		self.last = time.time()
+		return self.source(frame)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Headless NDVI batch processor for stored images, e.g. the Public Datasets captures
+
+usage: python ndvi_batch.py <directory or glob> [-o output] [--colour] [--workers N] [--force]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import cv2
+from ndvi import calculateNdvi
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+PERCENTILES = [5, 25, 50, 75, 95]
+HISTOGRAM_BINS = 20
+
+def findImages(pattern):
+	"""
+	Expands a directory or a glob into a sorted list of image files
+	"""
+	if os.path.isdir(pattern):
+		pattern = os.path.join(pattern, '*')
+	return sorted(p for p in glob.glob(pattern) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def outputPaths(path, outDir):
+	name = os.path.splitext(os.path.basename(path))[0]
+	return os.path.join(outDir, name + '.ndvi.json'), os.path.join(outDir, name + '.ndvi.png')
+
+def isUpToDate(path, outDir, colour):
+	"""
+	An image is up to date when its outputs exist and are newer than the image
+	"""
+	summaryPath, colourPath = outputPaths(path, outDir)
+	sourceTime = os.path.getmtime(path)
+	for output in ([summaryPath, colourPath] if colour else [summaryPath]):
+		if not os.path.exists(output) or os.path.getmtime(output) < sourceTime:
+			return False
+	return True
+
+def summarize(ndvi):
+	"""
+	Mean, extremes, percentiles and a fixed-range histogram of an NDVI array
+	"""
+	histogram = np.histogram(ndvi, bins=HISTOGRAM_BINS, range=(-1.0, 1.0))[0]
+	return {
+		'mean': float(ndvi.mean(dtype=np.float64)),
+		'min': float(ndvi.min()),
+		'max': float(ndvi.max()),
+		'percentiles': dict(('p%d' % p, float(v)) for p, v in zip(PERCENTILES, np.percentile(ndvi, PERCENTILES))),
+		'histogram': histogram.tolist(),
+	}
+
+def falseColour(ndvi):
+	"""
+	Maps NDVI -1..1 onto the JET colour map
+	"""
+	gray = np.empty(ndvi.shape, dtype=np.uint8)
+	np.copyto(gray, (ndvi + 1.0) * 127.5, casting='unsafe')
+	return cv2.applyColorMap(gray, cv2.COLORMAP_JET)
+
+def processImage(job):
+	"""
+	Worker task, computes and stores the NDVI summary of one image
+	"""
+	path, outDir, colour = job
+	img = cv2.imread(path)
+	if img is None:
+		return {'file': path, 'error': 'unreadable image'}
+	#bands are "bgr" as in the camera viewer, red carries the infrared band
+	ndvi = calculateNdvi(img[:, :, 2], img[:, :, 1], img[:, :, 0])
+	summary = summarize(ndvi)
+	summary['file'] = path
+	summary['width'] = img.shape[1]
+	summary['height'] = img.shape[0]
+	summaryPath, colourPath = outputPaths(path, outDir)
+	if colour:
+		cv2.imwrite(colourPath, falseColour(ndvi))
+	with open(summaryPath, 'w') as f:
+		json.dump(summary, f)
+	return summary
+
+def loadSummary(path, outDir):
+	with open(outputPaths(path, outDir)[0]) as f:
+		return json.load(f)
+
+def run(pattern, outDir, colour=False, workers=None, force=False):
+	"""
+	Processes every image matching pattern across a process pool, returns the summaries
+	"""
+	if not os.path.isdir(outDir):
+		os.makedirs(outDir)
+	images = findImages(pattern)
+	todo = [p for p in images if force or not isUpToDate(p, outDir, colour)]
+	print("%d images, %d to process, %d up to date" % (len(images), len(todo), len(images) - len(todo)))
+
+	startTime = time.time()
+	summaries = {}
+	if todo:
+		pool = multiprocessing.Pool(workers)
+		try:
+			jobs = [(p, outDir, colour) for p in todo]
+			for summary in pool.imap_unordered(processImage, jobs, chunksize=4):
+				summaries[summary['file']] = summary
+		finally:
+			pool.close()
+			pool.join()
+	totalTime = time.time() - startTime
+	if todo:
+		print("Processed %d images in %f s (%f images/s)" % (len(todo), totalTime, len(todo) / totalTime))
+
+	#the index covers every image, up to date ones are read back from their outputs
+	result = []
+	for p in images:
+		summary = summaries.get(p)
+		if summary is None:
+			summary = loadSummary(p, outDir)
+		result.append(summary)
+	with open(os.path.join(outDir, 'ndvi_summary.csv'), 'w') as f:
+		f.write('file,width,height,mean,min,max,' + ','.join('p%d' % p for p in PERCENTILES) + '\n')
+		for s in result:
+			if 'error' in s:
+				continue
+			values = [s['mean'], s['min'], s['max']] + [s['percentiles']['p%d' % p] for p in PERCENTILES]
+			f.write('%s,%d,%d,' % (os.path.basename(s['file']), s['width'], s['height']) + ','.join('%f' % v for v in values) + '\n')
+	return result
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Compute NDVI summaries for stored images')
+	parser.add_argument('images', help='directory or glob of images')
+	parser.add_argument('-o', '--output', default='ndvi_output', help='directory for the summaries')
+	parser.add_argument('--colour', action='store_true', help='also write false colour NDVI images')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the number of cores')
+	parser.add_argument('--force', action='store_true', help='reprocess images that are up to date')
+	args = parser.parse_args()
+	run(args.images, args.output, args.colour, args.workers, args.force)
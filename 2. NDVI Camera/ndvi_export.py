@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+NDVI product export: quantized, compressed NDVI rasters with their metadata, written by
+an encoder thread, and an optional MJPEG preview over HTTP for headless units
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+import numpy as np
+import cv2
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1. Computer', 'PlantOS Shield v2'))
+import metrics
+
+exportErrors = metrics.counter('plantos_ndvi_export_errors', "Frames the exporter failed to write or preview", ['stage'])
+
+#uint8 maps NDVI -1..1 onto 0..255 in steps of 2/255, float16 keeps about 3 significant digits
+ENCODINGS = ('uint8', 'float16')
+
+def quantize(ndvi, out=None):
+	"""
+	NDVI -1..1 as uint8 0..255, rounded to the nearest step
+	"""
+	if out is None:
+		out = np.empty(ndvi.shape, dtype=np.uint8)
+	scaled = (ndvi + 1.0) * 127.5 + 0.5
+	np.clip(scaled, 0, 255, out=scaled)
+	np.copyto(out, scaled, casting='unsafe')
+	return out
+
+def dequantize(q):
+	return q.astype(np.float32) / 127.5 - 1.0
+
+def encodeRaster(ndvi, encoding='uint8'):
+	"""
+	Returns the raster bytes of an encoding. float16 values are stored as two byte planes,
+	low bytes then high bytes (little endian), which deflate better than interleaved values
+	"""
+	if encoding == 'uint8':
+		return quantize(ndvi).tobytes()
+	if encoding == 'float16':
+		return np.ascontiguousarray(ndvi.astype(np.float16).view(np.uint8).reshape(-1, 2).T).tobytes()
+	raise ValueError("unknown encoding %s" % encoding)
+
+def decodeRaster(data, shape, encoding):
+	if encoding == 'uint8':
+		return dequantize(np.frombuffer(data, dtype=np.uint8).reshape(shape))
+	if encoding == 'float16':
+		planes = np.frombuffer(data, dtype=np.uint8).reshape(2, -1)
+		return np.ascontiguousarray(planes.T).view(np.float16).reshape(shape).astype(np.float32)
+	raise ValueError("unknown encoding %s" % encoding)
+
+def writeProduct(path, ndvi, meta, encoding='uint8'):
+	"""
+	Writes one NDVI product, a zip holding meta.json and the deflated raster. The file is
+	written next to path and renamed over it, so readers never see a partial product
+	"""
+	meta = dict(meta)
+	meta['encoding'] = encoding
+	meta['shape'] = list(ndvi.shape)
+	buf = io.BytesIO()
+	with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+		z.writestr('meta.json', json.dumps(meta))
+		info = zipfile.ZipInfo('ndvi.' + encoding, date_time=time.localtime(meta.get('timestamp', time.time()))[:6])
+		info.compress_type = zipfile.ZIP_DEFLATED
+		z.writestr(info, encodeRaster(ndvi, encoding))
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(buf.getvalue())
+	os.rename(tmp, path)
+	return len(buf.getvalue())
+
+def readProduct(path):
+	"""
+	Returns (ndvi as float32, meta) of a product file
+	"""
+	with zipfile.ZipFile(path) as z:
+		meta = json.loads(z.read('meta.json').decode('utf-8'))
+		data = z.read('ndvi.' + meta['encoding'])
+	return decodeRaster(data, tuple(meta['shape']), meta['encoding']), meta
+
+class NdviExporter:
+	"""
+	Takes NDVI frames from the pipeline sink and encodes them on its own thread. submit()
+	only copies the NDVI into a free buffer and queues it, a frame is dropped when every
+	buffer is in use rather than stalling the sink. Every nth frame is written as a
+	product under outDir/<date>/, and the preview, if any, gets a JPEG of each frame.
+	"""
+	def __init__(self, outDir=None, encoding='uint8', every=1, preview=None, buffers=3):
+		if encoding not in ENCODINGS:
+			raise ValueError("unknown encoding %s" % encoding)
+		self.outDir = outDir
+		self.encoding = encoding
+		self.every = every
+		self.preview = preview
+		self.free = queue.Queue()
+		for i in range(buffers):
+			self.free.put(None)     # allocated at the frame shape on first use
+		self.pending = queue.Queue()
+		self.thread = threading.Thread(target=self.encodeLoop)
+		self.thread.daemon = True
+		self.submitted = 0
+		self.dropped = 0
+		self.written = 0
+		self.failed = 0
+		self.bytesWritten = 0
+		self.thread.start()
+
+	def submit(self, ndvi, meta):
+		"""
+		Queues a frame with its metadata, e.g. timestamp, width, height and mean
+		"""
+		self.submitted += 1
+		wantProduct = self.outDir is not None and self.submitted % self.every == 0
+		if not wantProduct and (self.preview is None or not self.preview.wanted()):
+			return False
+		try:
+			buf = self.free.get_nowait()
+		except queue.Empty:
+			self.dropped += 1
+			return False
+		if buf is None or buf.shape != ndvi.shape:
+			buf = np.empty(ndvi.shape, dtype=np.float32)
+		np.copyto(buf, ndvi)
+		self.pending.put((buf, dict(meta), wantProduct))
+		return True
+
+	def encodeLoop(self):
+		while True:
+			item = self.pending.get()
+			if item is None:
+				break
+			buf, meta, wantProduct = item
+			#a failed frame, e.g. on a full SD card, must not stop the frames after it
+			try:
+				if wantProduct:
+					self.writeFrame(buf, meta)
+			except Exception as e:
+				self.failed += 1
+				exportErrors.inc(stage='product')
+				sys.stderr.write("NDVI export failed (%s)\n" % e)
+			try:
+				if self.preview is not None and self.preview.wanted():
+					self.preview.publish(buf)
+			except Exception as e:
+				exportErrors.inc(stage='preview')
+				sys.stderr.write("NDVI preview failed (%s)\n" % e)
+			self.free.put(buf)
+
+	def writeFrame(self, ndvi, meta):
+		timestamp = meta.get('timestamp', time.time())
+		directory = os.path.join(self.outDir, time.strftime('%Y%m%d', time.localtime(timestamp)))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		name = 'ndvi_%s_%03d.zip' % (time.strftime('%H%M%S', time.localtime(timestamp)), int(timestamp * 1000) % 1000)
+		self.bytesWritten += writeProduct(os.path.join(directory, name), ndvi, meta, self.encoding)
+		self.written += 1
+
+	def close(self):
+		"""
+		Encodes the queued frames and stops the thread
+		"""
+		self.pending.put(None)
+		self.thread.join()
+
+class MjpegPreview:
+	"""
+	Serves the latest frame as an MJPEG stream on http://<host>:port/, colour mapped,
+	scaled down and limited to maxFps. Nothing is encoded while no client is connected
+	"""
+	def __init__(self, port=8090, scale=0.5, quality=60, maxFps=2.0):
+		self.port = port
+		self.scale = scale
+		self.quality = quality
+		self.maxFps = maxFps
+		self.condition = threading.Condition()
+		self.jpeg = None
+		self.sequence = 0
+		self.clients = 0
+		self.lastPublished = 0.0
+		self.server = None
+
+	def wanted(self):
+		return self.clients > 0 and time.time() - self.lastPublished >= 1.0 / self.maxFps
+
+	def publish(self, ndvi):
+		self.lastPublished = time.time()
+		gray = quantize(ndvi)
+		if self.scale != 1.0:
+			gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+		ok, jpeg = cv2.imencode('.jpg', cv2.applyColorMap(gray, cv2.COLORMAP_JET),
+			[int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+		if not ok:
+			return
+		with self.condition:
+			self.jpeg = jpeg.tobytes()
+			self.sequence += 1
+			self.condition.notify_all()
+
+	def start(self):
+		try:
+			from http.server import BaseHTTPRequestHandler, HTTPServer
+			from socketserver import ThreadingMixIn
+		except ImportError:
+			from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+			from SocketServer import ThreadingMixIn
+		preview = self
+
+		class Server(ThreadingMixIn, HTTPServer):
+			daemon_threads = True
+
+			def handle_error(self, request, clientAddress):
+				pass        # clients closing the stream are not errors
+
+		class Stream(BaseHTTPRequestHandler):
+			def do_GET(self):
+				self.send_response(200)
+				self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+				self.send_header('Cache-Control', 'no-cache')
+				self.end_headers()
+				with preview.condition:
+					preview.clients += 1
+				seen = 0
+				try:
+					while True:
+						with preview.condition:
+							while preview.sequence == seen:
+								preview.condition.wait(1.0)
+							seen, jpeg = preview.sequence, preview.jpeg
+						self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n')
+						self.wfile.write(('Content-Length: %d\r\n\r\n' % len(jpeg)).encode('ascii'))
+						self.wfile.write(jpeg + b'\r\n')
+				except (IOError, OSError):
+					pass        # the client went away
+				finally:
+					with preview.condition:
+						preview.clients -= 1
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = Server(('', self.port), Stream)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
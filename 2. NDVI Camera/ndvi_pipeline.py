@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded capture -> compute -> sink pipeline for the NDVI viewer
+"""
+import threading
+import time
+import numpy as np
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+class Frame:
+	"""
+	A reusable frame slot, the image buffer and any per-slot state stay with the slot
+	"""
+	def __init__(self):
+		self.img = None
+		self.context = {}     # per-slot state of the stages, e.g. capture and NDVI buffers
+		self.result = None
+		self.index = 0
+		self.captured = 0.0
+		self.computed = 0.0
+
+class CameraSource:
+	"""
+	Captures straight into the frame buffer through the video port
+	"""
+	def __init__(self, camera):
+		self.camera = camera
+
+	def __call__(self, frame):
+		width, height = self.camera.resolution
+		# the camera writes rows padded to 32 pixels and 16 lines
+		padded = ((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3)
+		buf = frame.context.get('padded')
+		if buf is None or buf.shape != padded:
+			buf = frame.context['padded'] = np.empty(padded, dtype=np.uint8)
+		self.camera.capture(buf, format='bgr', use_video_port=True)
+		frame.img = buf[:height, :width]
+		return True
+
+class NdviPipeline:
+	"""
+	Runs capture, compute and sink as separate stages joined by bounded queues.
+	Frames move between stages by reference and come back to a free pool once the
+	last stage is done, when a queue is full the frame is dropped rather than
+	stalling the stage before it. The compute stage uses several threads, numpy
+	releases the GIL inside its array operations so they run on separate cores.
+	"""
+	def __init__(self, source, compute, sink=None, workers=4, depth=2):
+		self.source = source      # fills frame.img, returns False when there are no more frames
+		self.compute = compute    # processes frame in place and sets frame.result
+		self.sink = sink          # consumes a computed frame, returns False to stop, runs in the caller's thread
+		self.workers = workers
+		self.depth = depth
+		self.free = queue.Queue()
+		for i in range(workers + 2 * depth + 1):
+			self.free.put(Frame())
+		# the depth limit is applied by offer(), the queues themselves stay unbounded
+		# so the end-of-stream markers can always be queued
+		self.to_compute = queue.Queue()
+		self.to_sink = queue.Queue()
+		self.stopped = threading.Event()
+		self.captured = 0
+		self.dropped = 0
+		self.delivered = 0
+		self.last_index = -1
+
+	def release(self, frame):
+		self.free.put(frame)
+
+	def offer(self, q, frame):
+		if q.qsize() >= self.depth:
+			self.dropped += 1
+			self.release(frame)
+		else:
+			q.put(frame)
+
+	def captureLoop(self):
+		try:
+			while not self.stopped.is_set():
+				frame = self.free.get()
+				frame.captured = time.time()
+				if not self.source(frame):
+					self.release(frame)
+					break
+				frame.index = self.captured
+				self.captured += 1
+				self.offer(self.to_compute, frame)
+		finally:
+			for i in range(self.workers):
+				self.to_compute.put(None)
+
+	def computeLoop(self):
+		try:
+			while True:
+				frame = self.to_compute.get()
+				if frame is None:
+					break
+				self.compute(frame)
+				frame.computed = time.time()
+				if self.sink is None:
+					self.delivered += 1
+					self.release(frame)
+				else:
+					self.offer(self.to_sink, frame)
+		finally:
+			self.to_sink.put(None)
+
+	def stop(self):
+		self.stopped.set()
+
+	def run(self):
+		"""
+		Starts the capture and compute threads and runs the sink stage until the source
+		ends, the sink returns False or stop() is called
+		"""
+		capture = threading.Thread(target=self.captureLoop)
+		threads = [capture] + [threading.Thread(target=self.computeLoop) for i in range(self.workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		running = self.workers
+		try:
+			while running:
+				try:
+					# a timeout keeps the wait interruptible by ctrl-c
+					frame = self.to_sink.get(timeout=0.5)
+				except queue.Empty:
+					continue
+				if frame is None:
+					running -= 1
+					continue
+				# workers can finish out of order, never show an older frame after a newer one
+				if frame.index < self.last_index or self.stopped.is_set():
+					self.dropped += 1
+					self.release(frame)
+					continue
+				self.last_index = frame.index
+				self.delivered += 1
+				keepGoing = self.sink(frame)
+				self.release(frame)
+				if keepGoing is False:
+					self.stop()
+		finally:
+			self.stop()
+			# unblock the capture thread if it waits for a free frame, and let it finish
+			# its current capture before the caller closes the camera
+			self.free.put(Frame())
+			capture.join(2.0)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Per-region NDVI statistics, e.g. one region per tray cell, from a label image
+"""
+import numpy as np
+import cv2
+
+HISTOGRAM_BINS = 20
+
+def gridLabels(shape, rows, cols, margin=0):
+	"""
+	Label image of a rows x cols grid of cells numbered 1.. row by row, with margin
+	pixels around every cell left as background (0)
+	"""
+	height, width = shape[:2]
+	labels = np.zeros((height, width), dtype=np.int32)
+	for row in range(rows):
+		for col in range(cols):
+			top, bottom = row * height // rows, (row + 1) * height // rows
+			left, right = col * width // cols, (col + 1) * width // cols
+			labels[top + margin:bottom - margin, left + margin:right - margin] = row * cols + col + 1
+	return labels
+
+def polygonLabels(shape, polygons):
+	"""
+	Label image of polygons given as lists of (x, y) points, numbered 1.. in order,
+	later polygons are drawn over earlier ones where they overlap
+	"""
+	labels = np.zeros(shape[:2], dtype=np.int32)
+	for i, points in enumerate(polygons):
+		cv2.fillPoly(labels, [np.array(points, dtype=np.int32)], i + 1)
+	return labels
+
+class RegionStats:
+	"""
+	Mean NDVI, plant mean, plant coverage and an NDVI histogram of every region of a
+	fixed label image. A pixel counts as plant when its NDVI reaches ndviThreshold and,
+	if minGreen is set, its green band reaches minGreen. All regions come out of three
+	bincounts over the frame, the label keys they add to are computed once.
+	"""
+	def __init__(self, labels, bins=HISTOGRAM_BINS, ndviThreshold=0.2, minGreen=None):
+		self.shape = labels.shape
+		self.bins = bins
+		self.ndviThreshold = ndviThreshold
+		self.minGreen = minGreen
+		flat = labels.ravel().astype(np.intp)
+		self.regions = int(flat.max()) + 1
+		self.sizes = np.bincount(flat, minlength=self.regions)
+		self.plantKeys = flat * 2          # + 1 for plant pixels
+		self.histogramKeys = flat * bins   # + the NDVI bin
+		self.mask = np.empty(flat.size, dtype=bool)
+		self.green = np.empty(flat.size, dtype=bool)
+		self.keys = np.empty(flat.size, dtype=np.intp)
+		self.scaled = np.empty(flat.size, dtype=np.float32)
+
+	def compute(self, ndvi, g=None):
+		"""
+		Returns per-region arrays indexed by label, region 0 being the background:
+		pixels, mean, plantMean, coverage and histogram (regions x bins over -1..1)
+		"""
+		flat = ndvi.ravel()
+		np.greater_equal(flat, self.ndviThreshold, out=self.mask)
+		if self.minGreen is not None and g is not None:
+			np.greater_equal(g.ravel(), self.minGreen, out=self.green)
+			np.logical_and(self.mask, self.green, out=self.mask)
+
+		#region and plant/other split in one key, counts and NDVI sums per key
+		np.add(self.plantKeys, self.mask, out=self.keys)
+		counts = np.bincount(self.keys, minlength=2 * self.regions).reshape(self.regions, 2)
+		sums = np.bincount(self.keys, weights=flat, minlength=2 * self.regions).reshape(self.regions, 2)
+
+		#NDVI -1..1 onto bins 0..bins-1, truncated to the bin index
+		np.multiply(flat, self.bins / 2.0, out=self.scaled)
+		np.add(self.scaled, self.bins / 2.0, out=self.scaled)
+		np.clip(self.scaled, 0, self.bins - 1, out=self.scaled)
+		np.copyto(self.keys, self.scaled, casting='unsafe')
+		np.add(self.keys, self.histogramKeys, out=self.keys)
+		histogram = np.bincount(self.keys, minlength=self.regions * self.bins).reshape(self.regions, self.bins)
+
+		sizes = np.maximum(self.sizes, 1)
+		plants = counts[:, 1]
+		with np.errstate(invalid='ignore', divide='ignore'):
+			plantMean = np.where(plants > 0, sums[:, 1] / plants, np.nan)
+		return {
+			'pixels': self.sizes,
+			'mean': sums.sum(axis=1) / sizes,
+			'plantMean': plantMean,
+			'coverage': plants / sizes.astype(np.float64),
+			'histogram': histogram,
+		}
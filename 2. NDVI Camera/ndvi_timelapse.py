@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+NDVI time-lapse: per-pixel running statistics of a frame sequence kept on disk, change
+maps between checkpoints and per-cell growth curves, without storing the frames
+
+usage: python ndvi_timelapse.py images <directory or glob> [-o state] [--grid RxC] [--change-every N]
+       python ndvi_timelapse.py camera [-o state] [--interval S] [--grid RxC] [--change-every N]
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import time
+import numpy as np
+import cv2
+from ndvi import NdviEngine, resolution
+from ndvi_batch import findImages
+from ndvi_roi import RegionStats, gridLabels
+
+FIELDS = ('mean', 'min', 'max', 'level', 'trend', 'reference')
+
+class TimelapseAccumulator:
+	"""
+	Per-pixel NDVI statistics of every frame seen so far, in float32 arrays memory mapped
+	from files in path: running mean, min and max, and an exponentially weighted level
+	and trend per frame (Holt's linear smoothing with alpha and beta). A frame updates
+	all of them in one pass of in-place operations and is then discarded. reference is
+	the level at the last change map, changeMap() compares the level against it.
+
+	Frames update working copies (<field>.f32), checkpoint() copies them to the files of
+	a new generation (<field>.<generation>.f32) that meta.json then points to. Opening
+	the state starts from the generation of meta.json, so the frames added after the
+	last checkpoint are lost with a crash and are added again exactly once.
+	"""
+	def __init__(self, path, shape, alpha=0.1, beta=0.05):
+		self.path = path
+		self.metaPath = os.path.join(path, 'meta.json')
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		if os.path.exists(self.metaPath):
+			with open(self.metaPath) as f:
+				self.meta = json.load(f)
+		else:
+			self.meta = {'shape': list(shape[:2]), 'alpha': alpha, 'beta': beta, 'generation': 0,
+				'count': 0, 'changes': 0, 'first': None, 'last': None, 'lastName': None}
+		self.shape = tuple(self.meta['shape'])
+		self.arrays = {}
+		for field in FIELDS:
+			self.arrays[field] = np.memmap(os.path.join(path, field + '.f32'), dtype=np.float32,
+				mode='w+', shape=self.shape)
+			if self.meta['generation']:
+				np.copyto(self.arrays[field], np.memmap(self.committedPath(field, self.meta['generation']),
+					dtype=np.float32, mode='r', shape=self.shape))
+		self.removeGenerations(keep=self.meta['generation'])
+		self.error = np.empty(self.shape, dtype=np.float32)
+
+	def committedPath(self, field, generation):
+		return os.path.join(self.path, '%s.%d.f32' % (field, generation))
+
+	def removeGenerations(self, keep):
+		#older generations, and newer ones a crash left before meta.json pointed to them
+		for name in os.listdir(self.path):
+			parts = name.split('.')
+			if len(parts) == 3 and parts[0] in FIELDS and parts[2] == 'f32' and parts[1].isdigit() \
+					and int(parts[1]) != keep:
+				os.remove(os.path.join(self.path, name))
+
+	@property
+	def count(self):
+		return self.meta['count']
+
+	def update(self, ndvi, timestamp=None, name=None):
+		"""
+		Adds one NDVI frame of the accumulator shape
+		"""
+		a = self.arrays
+		alpha, beta = self.meta['alpha'], self.meta['beta']
+		if self.meta['count'] == 0:
+			for field in ('mean', 'min', 'max', 'level', 'reference'):
+				np.copyto(a[field], ndvi)
+			a['trend'].fill(0)
+			self.meta['first'] = timestamp
+		else:
+			#running mean, mean += (x - mean) / n
+			np.subtract(ndvi, a['mean'], out=self.error)
+			self.error *= 1.0 / (self.meta['count'] + 1)
+			a['mean'] += self.error
+			np.minimum(a['min'], ndvi, out=a['min'])
+			np.maximum(a['max'], ndvi, out=a['max'])
+			#Holt: with the forecast error e = x - (level + trend) the updates reduce to
+			#level += trend + alpha * e and trend += alpha * beta * e
+			np.subtract(ndvi, a['level'], out=self.error)
+			self.error -= a['trend']
+			a['level'] += a['trend']
+			self.error *= alpha
+			a['level'] += self.error
+			self.error *= beta
+			a['trend'] += self.error
+		self.meta['count'] += 1
+		self.meta['last'] = timestamp
+		self.meta['lastName'] = name
+
+	def changeMap(self, reset=True):
+		"""
+		Level change since the previous change map, the reference moves to the current
+		level unless reset is False
+		"""
+		change = self.arrays['level'] - self.arrays['reference']
+		if reset:
+			np.copyto(self.arrays['reference'], self.arrays['level'])
+			self.meta['changes'] += 1
+		return change
+
+	def checkpoint(self):
+		"""
+		Copies the working arrays to a new generation, then replaces the metadata by
+		rename, which commits both at once
+		"""
+		generation = self.meta['generation'] + 1
+		for field, array in self.arrays.items():
+			array.flush()
+			tmp = self.committedPath(field, generation) + '.tmp'
+			shutil.copyfile(os.path.join(self.path, field + '.f32'), tmp)
+			os.rename(tmp, self.committedPath(field, generation))
+		meta = dict(self.meta, generation=generation)
+		tmp = self.metaPath + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(meta, f)
+		os.rename(tmp, self.metaPath)
+		self.meta = meta
+		self.removeGenerations(keep=generation)
+
+def divergingColour(change, scale=0.2):
+	"""
+	Maps NDVI change -scale..scale onto the JET colour map, no change is the middle colour
+	"""
+	gray = np.empty(change.shape, dtype=np.uint8)
+	np.copyto(gray, np.clip((change / scale + 1.0) * 127.5, 0, 255), casting='unsafe')
+	return cv2.applyColorMap(gray, cv2.COLORMAP_JET)
+
+class Timelapse:
+	"""
+	Feeds frames to a TimelapseAccumulator in outDir, appends the mean NDVI, plant NDVI
+	and plant cover of every grid cell to growth.csv and writes a change map every
+	changeEvery frames. Frames of another size are resized to the accumulator shape.
+	"""
+	def __init__(self, outDir, shape, grid=(1, 1), changeEvery=24, checkpointEvery=1):
+		self.outDir = outDir
+		self.accumulator = TimelapseAccumulator(os.path.join(outDir, 'state'), shape)
+		self.shape = self.accumulator.shape
+		self.regionStats = RegionStats(gridLabels(self.shape, *grid))
+		self.changeEvery = changeEvery
+		self.checkpointEvery = checkpointEvery
+		self.engine = NdviEngine()
+		self.resized = None
+		self.growthPath = os.path.join(outDir, 'growth.csv')
+		self.truncateGrowth()
+		self.changeDir = os.path.join(outDir, 'changes')
+		if not os.path.isdir(self.changeDir):
+			os.makedirs(self.changeDir)
+
+	def truncateGrowth(self):
+		"""
+		Drops the rows of frames after the last checkpoint, they are added again
+		"""
+		lines = ['frame,time,name,cell,mean,plantMean,coverage\n']
+		if os.path.exists(self.growthPath):
+			with open(self.growthPath) as f:
+				rows = f.readlines()[1:]
+			for row in rows:
+				if not row.endswith('\n') or int(row.split(',', 1)[0]) > self.accumulator.count:
+					break
+				lines.append(row)
+			if len(lines) == len(rows) + 1:
+				return
+		with open(self.growthPath, 'w') as f:
+			f.writelines(lines)
+
+	def add(self, img, timestamp, name):
+		"""
+		Adds a "bgr" frame, returns the change map when one is due, otherwise None
+		"""
+		height, width = self.shape
+		if img.shape[:2] != self.shape:
+			if self.resized is None:
+				self.resized = np.empty((height, width, 3), dtype=np.uint8)
+			cv2.resize(img, (width, height), self.resized, interpolation=cv2.INTER_AREA)
+			img = self.resized
+		#red carries the infrared band
+		ndvi, average = self.engine.calculate(img[:, :, 2], img[:, :, 0])
+		accumulator = self.accumulator
+		accumulator.update(ndvi, timestamp, name)
+		regions = self.regionStats.compute(ndvi, img[:, :, 1])
+		with open(self.growthPath, 'a') as f:
+			for cell in range(1, len(regions['pixels'])):
+				f.write('%d,%f,%s,%d,%f,%f,%f\n' % (accumulator.count, timestamp, name, cell,
+					regions['mean'][cell], regions['plantMean'][cell], regions['coverage'][cell]))
+		change = None
+		if accumulator.count % self.changeEvery == 0:
+			change = accumulator.changeMap()
+			cv2.imwrite(os.path.join(self.changeDir, 'change_%06d.png' % accumulator.count), divergingColour(change))
+		if accumulator.count % self.checkpointEvery == 0 or change is not None:
+			accumulator.checkpoint()
+		return change
+
+	def export(self):
+		"""
+		Writes false colour images of the mean, minimum, maximum and trend
+		"""
+		arrays = self.accumulator.arrays
+		for field in ('mean', 'min', 'max'):
+			gray = np.empty(self.shape, dtype=np.uint8)
+			np.copyto(gray, np.clip((arrays[field] + 1.0) * 127.5, 0, 255), casting='unsafe')
+			cv2.imwrite(os.path.join(self.outDir, field + '.png'), cv2.applyColorMap(gray, cv2.COLORMAP_JET))
+		#the trend is per frame, shown over the span of one change map
+		cv2.imwrite(os.path.join(self.outDir, 'trend.png'), divergingColour(arrays['trend'] * self.changeEvery))
+		self.accumulator.checkpoint()
+
+def runImages(pattern, outDir, grid, changeEvery):
+	"""
+	Adds the images of a directory or glob in name order, images up to the last one
+	already added are skipped so a growing sequence is only ever processed once
+	"""
+	images = findImages(pattern)
+	if not images:
+		print("No images in %s" % pattern)
+		return None
+	first = cv2.imread(images[0])
+	if first is None:
+		print("Cannot read %s" % images[0])
+		return None
+	timelapse = Timelapse(outDir, first.shape, grid, changeEvery, checkpointEvery=50)
+	lastName = timelapse.accumulator.meta['lastName']
+	todo = [p for p in images if lastName is None or os.path.basename(p) > lastName]
+	print("%d images, %d new, %d frames accumulated" % (len(images), len(todo), timelapse.accumulator.count))
+	#ctrl-c stops between frames, a frame half added would be checkpointed below
+	interrupted = []
+	previousHandler = signal.signal(signal.SIGINT, lambda signum, stack: interrupted.append(signum))
+	startTime = time.time()
+	added = 0
+	try:
+		for path in todo:
+			if interrupted:
+				print("Interrupted, the next run resumes after %s" % timelapse.accumulator.meta['lastName'])
+				break
+			img = cv2.imread(path)
+			if img is None:
+				continue
+			#stored captures carry no capture time of their own, the file time stands in
+			timelapse.add(img, os.path.getmtime(path), os.path.basename(path))
+			added += 1
+	finally:
+		signal.signal(signal.SIGINT, previousHandler)
+	timelapse.export()
+	if added:
+		totalTime = time.time() - startTime
+		print("Added %d frames in %f s (%f frames/s)" % (added, totalTime, added / totalTime))
+	return timelapse
+
+def runCamera(outDir, grid, changeEvery, interval):
+	"""
+	Captures one frame every interval seconds until ctrl-c
+	"""
+	#imported here so the images mode runs on machines without a camera
+	import picamera
+	from ndvi_pipeline import CameraSource, Frame
+	with picamera.PiCamera() as camera:
+		camera.resolution = resolution[6]
+		time.sleep(2)
+		source = CameraSource(camera)
+		frame = Frame()
+		width, height = camera.resolution
+		timelapse = Timelapse(outDir, (height, width), grid, changeEvery)
+		try:
+			while True:
+				started = time.time()
+				source(frame)
+				timestamp = time.time()
+				timelapse.add(frame.img, timestamp, time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp)))
+				print("Frame %d, average NDVI level %f" % (timelapse.accumulator.count,
+					float(timelapse.accumulator.arrays['level'].mean(dtype=np.float64))))
+				time.sleep(max(interval - (time.time() - started), 0))
+		except KeyboardInterrupt:
+			pass
+		timelapse.export()
+	return timelapse
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Accumulate NDVI statistics over a frame sequence')
+	parser.add_argument('source', choices=['images', 'camera'], help='stored images or the Pi camera')
+	parser.add_argument('images', nargs='?', help='directory or glob of images, in time order by name')
+	parser.add_argument('-o', '--output', default='ndvi_timelapse', help='directory for the state and outputs')
+	parser.add_argument('--grid', default='1x1', help='rows x columns of tray cells for the growth curves')
+	parser.add_argument('--change-every', type=int, default=24, help='frames between change maps')
+	parser.add_argument('--interval', type=float, default=600, help='seconds between camera frames')
+	args = parser.parse_args()
+	grid = tuple(int(n) for n in args.grid.lower().split('x'))
+	if args.source == 'images':
+		if args.images is None:
+			parser.error('images needs a directory or glob')
+		runImages(args.images, args.output, grid, args.change_every)
+	else:
+		runCamera(args.output, grid, args.change_every, args.interval)
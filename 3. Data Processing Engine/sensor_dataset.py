@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+import calendar   # converts timestamps to epoch seconds
+import datetime
+import json
+import os
+import re
+import sys
+from array import array
+import numpy
+
+#
+#   Time-series sensor datasets
+#
+#   Two layouts are found in Public Datasets/time-series-sensor-data:
+#   - pivot exports (cityfarm-*.csv): a spreadsheet pivot with header rows, one
+#     sparse column per metric, one metric per row and "(blank)"/"Grand Total"
+#     rows at the end. The rows of one reading cycle are microseconds apart.
+#   - run-together logs (sample.csv): "timestamp,v1,...,v8" records written with
+#     no separator, so the last value is glued to the next timestamp.
+#   Both are parsed as streams into wide records (timestamp, {metric: value}) and
+#   can be converted to a columnar directory of .npy files that loads memory mapped.
+#
+
+# metrics of a run-together log record, in field order
+RUN_TOGETHER_COLUMNS = ['Temp', 'PH', 'ORP', 'DO', 'EC', 'TDS', 'Sal', 'GRV']
+
+PIVOT_SKIP_COLUMNS = ('(blank)', 'Grand Total')
+PIVOT_SKIP_ROWS = ('(blank)', 'Grand Total', 'Row Labels', '')
+CYCLE_GAP = 0.5   # seconds between pivot rows that still belong to the same reading cycle
+
+TIMESTAMP = re.compile(r'(\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d{1,6})?),')
+
+def parse_timestamp(text):
+    # naive timestamps are taken as UTC seconds since the epoch
+    date, _, micro = text.replace('T', ' ').partition('.')
+    t = datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(t.timetuple()) + (float('0.' + micro) if micro else 0.0)
+
+def parse_value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def read_pivot(f):
+    # yields (timestamp, {metric: value}) per reading cycle of a pivot export
+    columns = None
+    cycle_time = None
+    last_time = None
+    values = {}
+    for line in f:
+        fields = line.rstrip('\r\n').split(',')
+        if columns is None:
+            if fields[0] == 'Row Labels':
+                columns = fields
+            continue
+        if fields[0] in PIVOT_SKIP_ROWS:
+            continue
+        t = parse_timestamp(fields[0])
+        row = {}
+        for i in range(1, min(len(fields), len(columns))):
+            if fields[i] and columns[i] not in PIVOT_SKIP_COLUMNS:
+                v = parse_value(fields[i])
+                if v is not None:
+                    row[columns[i]] = v
+        # a new cycle starts after a gap or when a metric shows up twice
+        if cycle_time is not None and (t - last_time > CYCLE_GAP or any(m in values for m in row)):
+            yield cycle_time, values
+            cycle_time = None
+            values = {}
+        if cycle_time is None:
+            cycle_time = t
+        last_time = t
+        values.update(row)
+    if cycle_time is not None:
+        yield cycle_time, values
+
+def read_run_together(f, columns=RUN_TOGETHER_COLUMNS, chunk_size=65536):
+    # yields (timestamp, {metric: value}) per record of a run-together log
+    pending = ''
+    while True:
+        chunk = f.read(chunk_size)
+        pending += chunk
+        matches = list(TIMESTAMP.finditer(pending))
+        # the last record is only complete once the next timestamp (or the end) is seen
+        complete = matches if not chunk else matches[:-1]
+        for i in range(len(complete)):
+            m = complete[i]
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(pending)
+            fields = pending[m.end():end].strip().split(',')
+            values = {}
+            for name, text in zip(columns, fields):
+                v = parse_value(text)
+                if v is not None:
+                    values[name] = v
+            yield parse_timestamp(m.group(1)), values
+        if not chunk:
+            break
+        if complete:
+            pending = pending[matches[len(complete)].start():]
+
+def read_dataset(path):
+    # streams the wide records of either layout, detected from the first bytes
+    with open(path) as f:
+        head = f.read(64)
+        f.seek(0)
+        if head.startswith('Sum of') or head.startswith('Row Labels'):
+            reader = read_pivot(f)
+        else:
+            reader = read_run_together(f)
+        for record in reader:
+            yield record
+
+#
+#   Columnar store
+#
+
+def columnar_path(path):
+    return os.path.splitext(path)[0] + '.columns'
+
+def convert(path, out_dir=None):
+    # writes timestamp.npy (float64) and one float32 .npy per metric, NaN where missing
+    out_dir = out_dir or columnar_path(path)
+    timestamps = array('d')
+    columns = {}
+    rows = 0
+    for t, values in read_dataset(path):
+        timestamps.append(t)
+        for name, v in values.items():
+            if name not in columns:
+                columns[name] = array('f', [float('nan')]) * rows
+            columns[name].append(v)
+        rows += 1
+        for name in columns:
+            if len(columns[name]) < rows:
+                columns[name].append(float('nan'))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    numpy.save(os.path.join(out_dir, 'timestamp.npy'), numpy.frombuffer(timestamps, dtype=numpy.float64))
+    for name in columns:
+        numpy.save(os.path.join(out_dir, name + '.npy'), numpy.frombuffer(columns[name], dtype=numpy.float32))
+    stat = os.stat(path)
+    meta = {'source': os.path.basename(path), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime,
+            'rows': rows, 'columns': sorted(columns)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return out_dir
+
+def is_current(path, out_dir):
+    try:
+        with open(os.path.join(out_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    stat = os.stat(path)
+    return meta['source_size'] == stat.st_size and meta['source_mtime'] == stat.st_mtime
+
+def load(path):
+    # returns {'timestamp': array, metric: array}, memory mapped from the columnar
+    # copy of the dataset, which is (re)built first when missing or stale
+    out_dir = path if os.path.isdir(path) else columnar_path(path)
+    if not os.path.isdir(path) and not is_current(path, out_dir):
+        convert(path, out_dir)
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    data = {'timestamp': numpy.load(os.path.join(out_dir, 'timestamp.npy'), mmap_mode='r')}
+    for name in meta['columns']:
+        data[name] = numpy.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r')
+    return data
+
+if __name__ == '__main__':
+    # python sensor_dataset.py <csv> [...], converts each dataset to its columnar copy
+    for path in sys.argv[1:]:
+        out_dir = convert(path)
+        data = load(out_dir)
+        print("%s: %d records, %s -> %s" % (path, len(data['timestamp']),
+                                              ', '.join(sorted(k for k in data if k != 'timestamp')), out_dir))
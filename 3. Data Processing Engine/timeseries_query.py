@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+import json
+import os
+import re
+import sys
+import numpy
+import sensor_dataset
+
+# the on-device store lives with the shield scripts
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', '1. Computer', 'PlantOS Shield v2'))
+import sensor_store
+
+#
+#   Windowed aggregation queries
+#
+#   TimeSeries answers "mean, median, min, max and count of these metrics per bucket
+#   between start and end" for a public dataset or a SensorStore directory. Rows are
+#   kept sorted by timestamp, and per-bucket partial aggregates (count, sum, min, max)
+#   are kept at 1 minute, 1 hour and 1 day. A query whose bucket and range line up
+#   with one of those widths combines partials only, so a month of 1 day buckets
+#   reads ~30 partials whatever the number of rows. Other buckets read the rows of the
+#   range, found with a binary search on the timestamps. So does the median, which
+#   cannot be combined from partials; it is only computed when asked for.
+#
+#   A SensorStore already keeps 1 minute and 1 hour rollups, these are its partials
+#   and cover the 90 day and 5 year retention of the rollups. Its raw tier, which
+#   keeps 14 days, serves the rows, so medians of older buckets are NaN.
+#
+
+LEVELS = (60, 3600, 86400)      # seconds, widths of the partial aggregates
+STATS = ('mean', 'min', 'max', 'count')   # answered from the partials
+ALL_STATS = ('mean', 'median', 'min', 'max', 'count')
+
+class Partials:
+    # count, sum, min and max of every metric per bucket of one width, buckets aligned
+    # to multiples of the width since the epoch, only buckets holding rows are kept
+
+    def __init__(self, width, starts, count, total, low, high):
+        self.width = width
+        self.starts = starts        # float64 (buckets,)
+        self.count = count          # int64 (buckets, metrics), values that are not NaN
+        self.total = total          # float64
+        self.low = low              # float64, NaN for buckets without values
+        self.high = high
+
+    @classmethod
+    def empty(cls, width, metrics):
+        return cls(width, numpy.empty(0), numpy.zeros((0, metrics), dtype=numpy.int64),
+                   numpy.zeros((0, metrics)), numpy.zeros((0, metrics)), numpy.zeros((0, metrics)))
+
+    @classmethod
+    def from_rows(cls, width, timestamps, values):
+        # partials of rows sorted by timestamp, values is (rows, metrics) with NaN gaps
+        if len(timestamps) == 0:
+            return cls.empty(width, values.shape[1])
+        ids = numpy.floor(timestamps / width)
+        first = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        valid = ~numpy.isnan(values)
+        return cls(width, ids[first] * width,
+                   numpy.add.reduceat(valid.astype(numpy.int64), first, axis=0),
+                   numpy.add.reduceat(numpy.where(valid, values, 0).astype(numpy.float64), first, axis=0),
+                   numpy.fmin.reduceat(values, first, axis=0).astype(numpy.float64),
+                   numpy.fmax.reduceat(values, first, axis=0).astype(numpy.float64))
+
+    def coarsen(self, width):
+        # combines the buckets into buckets of a multiple of the width
+        if len(self.starts) == 0:
+            return Partials.empty(width, self.count.shape[1])
+        ids = numpy.floor(self.starts / width)
+        first = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        return Partials(width, ids[first] * width,
+                        numpy.add.reduceat(self.count, first, axis=0),
+                        numpy.add.reduceat(self.total, first, axis=0),
+                        numpy.fmin.reduceat(self.low, first, axis=0),
+                        numpy.fmax.reduceat(self.high, first, axis=0))
+
+    def select(self, start=None, end=None, columns=None):
+        # the buckets with start <= bucket start < end, of some metric columns
+        lo = 0 if start is None else numpy.searchsorted(self.starts, start, 'left')
+        hi = len(self.starts) if end is None else numpy.searchsorted(self.starts, end, 'left')
+        c = slice(None) if columns is None else columns
+        return Partials(self.width, self.starts[lo:hi], self.count[lo:hi, c], self.total[lo:hi, c],
+                        self.low[lo:hi, c], self.high[lo:hi, c])
+
+    def extend(self, other):
+        # appends the buckets of other that start after the last bucket of self
+        other = other.select(self.starts[-1] + self.width if len(self.starts) else None)
+        return Partials(self.width, numpy.concatenate([self.starts, other.starts]),
+                        numpy.concatenate([self.count, other.count]),
+                        numpy.concatenate([self.total, other.total]),
+                        numpy.concatenate([self.low, other.low]),
+                        numpy.concatenate([self.high, other.high]))
+
+def bucket_medians(timestamps, values, width):
+    # median of every metric per bucket of rows sorted by timestamp, with the bucket
+    # starts and the number of values behind each median
+    ids = numpy.floor(timestamps / width)
+    first = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]]) if len(ids) else numpy.zeros(0, dtype=numpy.intp)
+    medians = numpy.full((len(first), values.shape[1]), numpy.nan)
+    counts = numpy.zeros((len(first), values.shape[1]), dtype=numpy.int64)
+    for j in range(values.shape[1]):
+        column = values[:, j]
+        # rows stay grouped by bucket, NaN sorts after the values within each bucket
+        order = numpy.lexsort((column, ids))
+        ordered = column[order]
+        count = numpy.add.reduceat((~numpy.isnan(column)).astype(numpy.intp), first) if len(first) else numpy.zeros(0, dtype=numpy.intp)
+        has = count > 0
+        lo = first[has] + (count[has] - 1) // 2
+        hi = first[has] + count[has] // 2
+        medians[has, j] = (ordered[lo].astype(numpy.float64) + ordered[hi]) / 2
+        counts[:, j] = count
+    return ids[first] * width, medians, counts
+
+class TimeSeries:
+    # Sorted rows of a set of metrics with their partial aggregates, see the module
+    # comment. rows are (timestamps, values (rows, metrics)) and partials maps a width
+    # to Partials; missing levels are built from the rows.
+
+    def __init__(self, fields, timestamps, values, partials=None):
+        self.fields = list(fields)
+        order = None
+        if len(timestamps) > 1 and numpy.any(numpy.diff(timestamps) < 0):
+            order = numpy.argsort(timestamps, kind='mergesort')
+        self.timestamps = numpy.asarray(timestamps if order is None else timestamps[order], dtype=numpy.float64)
+        self.values = numpy.asarray(values if order is None else values[order])
+        self.partials = dict(partials or {})
+        for width in LEVELS:
+            finer = [w for w in sorted(self.partials) if w < width and width % w == 0]
+            if width in self.partials:
+                continue
+            if finer:
+                self.partials[width] = self.partials[finer[-1]].coarsen(width)
+            else:
+                self.partials[width] = Partials.from_rows(width, self.timestamps, self.values)
+
+    @classmethod
+    def from_dataset(cls, path):
+        # a public dataset (csv or its .columns directory), metrics named as in the file
+        data = sensor_dataset.load(path)
+        fields = sorted(k for k in data if k != 'timestamp')
+        values = numpy.empty((len(data['timestamp']), len(fields)), dtype=numpy.float32)
+        for j in range(len(fields)):
+            values[:, j] = data[fields[j]]
+        return cls(fields, numpy.array(data['timestamp']), values)
+
+    @classmethod
+    def from_store(cls, path):
+        # a SensorStore directory, metrics named as in STAT_METRICS; it is only read,
+        # so the polling script can keep appending to it
+        with open(os.path.join(path, 'meta.json')) as f:
+            fields = json.load(f)['fields']
+        raw = read_tier(os.path.join(path, 'raw'), sensor_store.raw_dtype(fields))
+        timestamps = raw['timestamp']
+        values = raw['values']
+        partials = {}
+        for name, width in (('1min', 60), ('1hour', 3600)):
+            rollup = read_tier(os.path.join(path, name), sensor_store.rollup_dtype(fields))
+            count = rollup['count'].astype(numpy.int64)
+            level = Partials(width, rollup['timestamp'], count,
+                             numpy.where(count > 0, rollup['mean'], 0).astype(numpy.float64) * count,
+                             rollup['min'].astype(numpy.float64), rollup['max'].astype(numpy.float64))
+            # buckets the store has not written yet come from the finer level or the rows
+            if partials:
+                tail = partials[max(partials)].coarsen(width)
+            else:
+                tail = Partials.from_rows(width, timestamps, values)
+            partials[width] = level.extend(tail)
+        return cls(fields, timestamps, values, partials)
+
+    def level_for(self, bucket, start, end):
+        # the widest partials that buckets and range edges line up with, None for rows
+        for width in sorted(self.partials, reverse=True):
+            if bucket % width == 0 and all(t is None or t % width == 0 for t in (start, end)):
+                return self.partials[width]
+        return None
+
+    def rows(self, start=None, end=None, columns=None):
+        lo = 0 if start is None else numpy.searchsorted(self.timestamps, start, 'left')
+        hi = len(self.timestamps) if end is None else numpy.searchsorted(self.timestamps, end, 'left')
+        return self.timestamps[lo:hi], self.values[lo:hi][:, columns]
+
+    def query(self, metrics, start=None, end=None, bucket=3600, stats=STATS):
+        # {'start': bucket starts, metric: {stat: array per bucket}} for the buckets of
+        # width bucket (aligned to the epoch) with rows between start and end, stats
+        # among ALL_STATS; asking for 'median' reads every row of the range
+        unknown = [m for m in metrics if m not in self.fields]
+        if unknown:
+            raise KeyError("unknown metrics %s, available: %s" % (', '.join(unknown), ', '.join(self.fields)))
+        for stat in stats:
+            if stat not in ALL_STATS:
+                raise ValueError("unknown statistic %s" % stat)
+        columns = [self.fields.index(m) for m in metrics]
+        level = self.level_for(bucket, start, end)
+        if level is not None:
+            partials = level.select(start, end, columns).coarsen(bucket)
+        else:
+            partials = Partials.from_rows(bucket, *self.rows(start, end, columns))
+        result = {'start': partials.starts}
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(partials.count > 0, partials.total / partials.count, numpy.nan)
+        if 'median' in stats:
+            starts, medians, counts = bucket_medians(*(self.rows(start, end, columns) + (bucket,)))
+            median = numpy.full(mean.shape, numpy.nan)
+            at = numpy.searchsorted(partials.starts, starts)
+            known = at < len(partials.starts)
+            known[known] = partials.starts[at[known]] == starts[known]
+            # a bucket whose oldest rows have expired keeps a NaN median
+            median[at[known]] = numpy.where(counts[known] == partials.count[at[known]], medians[known], numpy.nan)
+        for j in range(len(metrics)):
+            series = {}
+            for stat in stats:
+                if stat == 'mean':
+                    series[stat] = mean[:, j]
+                elif stat == 'median':
+                    series[stat] = median[:, j]
+                elif stat == 'min':
+                    series[stat] = numpy.where(partials.count[:, j] > 0, partials.low[:, j], numpy.nan)
+                elif stat == 'max':
+                    series[stat] = numpy.where(partials.count[:, j] > 0, partials.high[:, j], numpy.nan)
+                else:
+                    series[stat] = partials.count[:, j]
+            result[metrics[j]] = series
+        return result
+
+def read_tier(path, dtype):
+    # every record of a SensorStore tier, oldest first, without writing to it: a record
+    # being appended is left out rather than truncated
+    starts = sorted([int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg')]) if os.path.isdir(path) else []
+    parts = []
+    for start in starts:
+        name = os.path.join(path, '%d.seg' % start)
+        rows = os.path.getsize(name) // dtype.itemsize
+        if rows:
+            parts.append(numpy.array(numpy.memmap(name, dtype=dtype, mode='r', shape=(rows,))))
+    if not parts:
+        return numpy.empty(0, dtype=dtype)
+    return numpy.concatenate(parts)
+
+def open_series(path):
+    # a SensorStore directory or a public dataset
+    if os.path.isdir(path) and os.path.isdir(os.path.join(path, 'raw')):
+        return TimeSeries.from_store(path)
+    return TimeSeries.from_dataset(path)
+
+def parse_bucket(text):
+    # "90", "15m", "1h" or "7d" as seconds
+    m = re.match(r'^(\d+(?:\.\d+)?)([smhd]?)$', text.strip().lower())
+    if m is None:
+        raise ValueError("bucket must look like 90, 15m, 1h or 7d")
+    return float(m.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+
+def parse_time(text):
+    # "2017-08-01" or "2017-08-01 12:00:00", UTC like the datasets
+    if text is None:
+        return None
+    return sensor_dataset.parse_timestamp(text if ' ' in text or 'T' in text else text + ' 00:00:00')
+
+if __name__ == '__main__':
+    # python timeseries_query.py <dataset or store> -m PH -m EC [--start ...] [--end ...] [--bucket 1d]
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Aggregate sensor metrics per time bucket")
+    parser.add_argument('source', help="dataset csv, its .columns directory or a SensorStore directory")
+    parser.add_argument('-m', '--metric', action='append', help="metric to aggregate, all when omitted")
+    parser.add_argument('--start', help="first time, UTC, e.g. 2017-08-01")
+    parser.add_argument('--end', help="time after the last bucket, UTC")
+    parser.add_argument('--bucket', default='1h', help="bucket width, e.g. 15m, 1h, 1d")
+    parser.add_argument('--median', action='store_true', help="also the median, read from the rows of the range")
+    args = parser.parse_args()
+
+    series = open_series(args.source)
+    metrics = args.metric or series.fields
+    stats = ALL_STATS if args.median else STATS
+    result = series.query(metrics, parse_time(args.start), parse_time(args.end), parse_bucket(args.bucket), stats)
+    print("bucket,metric," + ",".join(stats))
+    for i in range(len(result['start'])):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(result['start'][i]))
+        for m in metrics:
+            print("%s,%s,%s" % (when, m, ",".join(["%g" % result[m][s][i] for s in stats])))
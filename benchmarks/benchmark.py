@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import numpy
+
+#
+#   plantOS benchmarks
+#
+#   python benchmarks/benchmark.py [--output results.json] [--compare baseline.json]
+#   times the polling, statistics and NDVI hot paths off the Pi and writes the
+#   results as JSON; with --compare, cases slower than the baseline by more than
+#   --tolerance are reported and the exit status is 1. The scripts under test are
+#   python 2, so is this runner.
+#
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, '1. Computer', 'PlantOS Shield v2'))
+sys.path.append(os.path.join(ROOT, '2. NDVI Camera'))
+
+timer = timeit.default_timer    # taken before the simulator patches time.time
+
+def measure(func, min_time=0.5, min_runs=5, max_runs=2000):
+    # runs func until both min_time and min_runs are reached, returns timings in ms
+    func()      # warm up buffers and caches
+    times = []
+    start = timer()
+    while len(times) < max_runs and (len(times) < min_runs or timer() - start < min_time):
+        t = timer()
+        func()
+        times.append(timer() - t)
+    times = numpy.array(times) * 1000.0
+    return {'runs': len(times),
+            'min_ms': float(times.min()),
+            'median_ms': float(numpy.median(times)),
+            'mean_ms': float(times.mean()),
+            'p95_ms': float(numpy.percentile(times, 95)),
+            'per_second': float(1000.0 / numpy.median(times))}
+
+#
+#   NDVI
+#
+
+def bench_ndvi(min_time):
+    import ndvi
+    results = []
+    random = numpy.random.RandomState(0)
+    for width, height in ndvi.resolution:
+        img = random.randint(0, 256, (height, width, 3)).astype(numpy.uint8)
+        b, g, r = [numpy.ascontiguousarray(img[:, :, i]) for i in range(3)]
+        size = '%dx%d' % (width, height)
+        results.append(('calculateNdvi/' + size, measure(lambda: ndvi.calculateNdvi(r, g, b), min_time)))
+        result = ndvi.calculateNdvi(r, g, b)
+        # composeImages draws the labels into the bands, so it gets copies of its own
+        bands = [r.copy(), g.copy(), b.copy()]
+        results.append(('displayImage/' + size, measure(
+            lambda: ndvi.composeImages(img, bands[0], bands[1], bands[2], result), min_time)))
+    return results
+
+#
+#   Statistics
+#
+
+def bench_stats(min_time):
+    from rolling_stats import RollingStats
+    import sensor_polling_stat
+    results = []
+    channels = len(sensor_polling_stat.STAT_METRICS)
+    random = numpy.random.RandomState(0)
+    for window in (6, 60, 360, 3600, 8640):
+        stat = RollingStats(window, channels)
+        for i in range(window):     # start from a full window
+            stat.push(random.normal(25, 5, channels))
+        rows = random.normal(25, 5, (1024, channels))
+        rows[::17, 0] = numpy.nan   # failed DHT22 readings
+        tick = [0]
+
+        def update():
+            # one polling tick of sensor_polling_stat: push the sample, print mean and median
+            stat.push(rows[tick[0] % len(rows)])
+            tick[0] += 1
+            stat.mean()
+            stat.median()
+        results.append(('RollingStats/window=%d' % window, measure(update, min_time)))
+    return results
+
+#
+#   Atlas replies
+#
+
+def bench_atlas(min_time):
+    from shield_sensors import AtlasI2C
+    from sensor_sim import Simulator
+    results = []
+    # a simulated bus of its own, on which conversions complete instantly
+    sim = Simulator(speed=1e9)
+    sim.bus.bus = 'benchmark'
+    sim.bus.register(sim.bus.bus, sim.bus)
+    try:
+        device = AtlasI2C(bus=sim.bus.bus)
+        replies = {'pH': '6.012', 'EC': '2842,1534,1.47,1.001', 'RTD': '31.104'}
+        for kind in sorted(replies):
+            # framed as the boards answer: status, characters with the MSB set, null padding
+            raw = bytes((bytearray([1]) + bytearray([ord(c) | 0x80 for c in replies[kind]]) + bytearray(31))[:31])
+            results.append(('AtlasI2C.decode/' + kind, measure(lambda: device.decode(raw), min_time)))
+
+        # write and read back, the parsing path of the polling loop
+        for addr in (99, 100, 102):
+            def reading():
+                device.write("R", addr)
+                device.read_values(addr=addr)
+            results.append(('AtlasI2C.read_values/%d' % addr, measure(reading, min_time)))
+    finally:
+        sim.bus.close()
+    return results
+
+#
+#   Polling cycle
+#
+
+def bench_cycle(min_time, speed=1000.0):
+    # one tick of sensor_polling_stat on the simulated shield at speed times real time,
+    # the Atlas conversion wait takes long_timeout / speed of the measured latency
+    from sensor_sim import Simulator
+    from shield_sensors import AtlasI2C, BH1750
+    from dht_sampler import DHTSampler
+    from light_sampler import LightSampler
+    from rolling_stats import RollingStats
+    from i2c_discovery import I2CDiscovery
+    import sensor_polling_stat
+
+    sim = Simulator(speed=speed, dht_failure_rate=0.0)
+    sim.install()
+    try:
+        device = AtlasI2C()
+        light = LightSampler(BH1750())
+        dht = DHTSampler(24)
+        light.start()
+        dht.start()
+        discovery = I2CDiscovery()
+        devices = discovery.device_map()
+        addresses = [addr for addr in discovery.atlas_addresses() if devices[addr] in sensor_polling_stat.ATLAS_COLUMNS]
+        metrics = sensor_polling_stat.STAT_METRICS
+        stat = RollingStats(6, len(metrics))
+        sample = numpy.empty(len(metrics))
+
+        def cycle():
+            sample.fill(numpy.nan)
+            humidity, temperature, age = dht.latest()
+            if humidity is not None:
+                sample[0] = temperature
+                sample[1] = humidity
+            for reading in device.query_all(addresses, values=True):
+                if reading.status == 1:
+                    sample[sensor_polling_stat.ATLAS_COLUMNS[devices[reading.address]]] = reading.values
+            lux, age = light.latest()
+            if lux is not None:
+                sample[8] = lux
+            stat.push(sample)
+            stat.mean()
+            stat.median()
+
+        result = measure(cycle, min_time)
+        result['speed'] = speed
+        result['conversion_wait_ms'] = AtlasI2C.long_timeout / speed * 1000.0
+        light.stop()
+        dht.stop()
+        light.join()
+        dht.join()
+    finally:
+        sim.uninstall()
+    return [('poll_cycle/simulated_bus', result)]
+
+SUITES = [('ndvi', bench_ndvi), ('stats', bench_stats), ('atlas', bench_atlas), ('cycle', bench_cycle)]
+
+#
+#   Reporting
+#
+
+def environment():
+    try:
+        import cv2
+        opencv = cv2.__version__
+    except ImportError:
+        opencv = None
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'opencv': opencv}
+
+def compare(results, baseline, tolerance):
+    # prints the median of every case next to the baseline, returns the regressions
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['median_ms']
+        new = results[name]['median_ms']
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-40s %10.3f ms %10.3f ms %7.2fx%s" % (name, old, new, ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the plantOS hot paths")
+    parser.add_argument('--output', help="JSON file the results are written to")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds spent on each case")
+    parser.add_argument('--suite', action='append', choices=[s[0] for s in SUITES], help="suites to run, default all")
+    args = parser.parse_args()
+
+    results = {}
+    for name, suite in SUITES:
+        if args.suite and name not in args.suite:
+            continue
+        for case, result in suite(args.min_time):
+            results[case] = result
+            print("%-40s %10.3f ms  (p95 %.3f ms, %d runs)" % (case, result['median_ms'], result['p95_ms'], result['runs']))
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)